@@ -62,10 +62,13 @@ def build():
     '''
     Build dist package.
     '''
-    includes = ['static', 'templates', 'favicon.ico', '*.py']
+    includes = ['static', 'templates', 'templates_compiled', 'favicon.ico', '*.py']
     excludes = ['test', '.*', '*.pyc', '*.pyo']
     local('rm -f dist/%s' % _TAR_FILE)
     with lcd(os.path.join(_current_path(), 'www')):
+        # 预编译所有模板，生产模式(configs.jinja2.production)下worker启动时不需要再编译模板
+        local('rm -rf templates_compiled')
+        local('python3 templating.py templates_compiled')
         cmd = ['tar', '--dereference', '-czvf', '../dist/%s' % _TAR_FILE]
         cmd.extend(['--exclude=\'%s\'' % ex for ex in excludes])
         cmd.extend(includes)
@@ -85,6 +88,15 @@ $ fab build
 _REMOTE_TMP_TAR = '/tmp/%s' % _TAR_FILE
 _REMOTE_BASE_DIR = '/srv/jsnwebapp'
 
+def _reload_app():
+    '''
+    Graceful reload: master re-execs with the new code in www, old workers finish in-flight requests
+    and exit once the new workers are ready (see www/prefork.py). Start the app if it is not running.
+    '''
+    r = sudo('supervisorctl signal HUP jsnwebapp')
+    if r.failed or 'ERROR' in r:
+        sudo('supervisorctl start jsnwebapp')
+
 def deploy():
     newdir = 'www-%s' % _now()
     # 删除已有的tar文件:
@@ -99,14 +111,15 @@ def deploy():
         sudo('tar -xzvf %s' % _REMOTE_TMP_TAR)
     # 重置软链接:
     with cd(_REMOTE_BASE_DIR):
+        sudo('mkdir -p run') # app.py监听的Unix domain socket所在目录
+        sudo('chown www-data:www-data run')
         sudo('rm -f www')
         sudo('ln -s %s www' % newdir)
         sudo('chown www-data:www-data www')
         sudo('chown -R www-data:www-data %s' % newdir)
-    # 重启Python服务和nginx服务器:
+    # 平滑重启Python服务，重新加载nginx配置:
     with settings(warn_only=True):
-        sudo('supervisorctl stop jsnwebapp')
-        sudo('supervisorctl start jsnwebapp')
+        _reload_app()
         sudo('/etc/init.d/nginx reload')
 '''
 注意run()函数执行的命令是在服务器上运行，with cd(path)和with lcd(path)类似，
@@ -157,8 +170,7 @@ def rollback():
         sudo('ln -s %s www' % old)
         sudo('chown www-data:www-data www')
         with settings(warn_only=True):
-            sudo('supervisorctl stop jsnwebapp')
-            sudo('supervisorctl start jsnwebapp')
+            _reload_app()
             sudo('/etc/init.d/nginx reload')
         print('ROLLBACKED OK.')
 
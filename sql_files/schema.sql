@@ -30,6 +30,8 @@ CREATE TABLE blogs(
     `summary` varchar(200) not null,
     `content` mediumtext not null,
     `created_at` real not null,
+    `updated_at` real not null,
+    `comment_count` bigint not null,
     key `idx_created_at` (`created_at`),
     primary key (`id`)
 ) engine=innodb default charset=utf8;
@@ -41,7 +43,9 @@ create table comments (
     `user_name` varchar(50) not null,
     `user_image` varchar(500) not null,
     `content` mediumtext not null,
+    `html_content` mediumtext not null,
     `created_at` real not null,
     key `idx_created_at` (`created_at`),
+    key `idx_blog_created_at` (`blog_id`, `created_at`),
     primary key (`id`)
 ) engine=innodb default charset=utf8;
@@ -0,0 +1,16 @@
+-- 已有数据库的升级脚本，按顺序执行新增的部分即可；新建数据库直接使用schema.sql
+-- $ mysql -u root -p db_web < upgrade.sql
+
+USE db_web;
+
+-- blogs.updated_at: 日志或其评论的最后修改时间，用于条件GET(Last-Modified/ETag)
+ALTER TABLE blogs ADD COLUMN `updated_at` real not null default 0;
+UPDATE blogs SET `updated_at` = `created_at`;
+
+-- blogs.comment_count: 随评论增删维护的评论数；comments按(blog_id, created_at)分页查询
+ALTER TABLE blogs ADD COLUMN `comment_count` bigint not null default 0;
+UPDATE blogs b SET `comment_count` = (SELECT count(c.`id`) FROM comments c WHERE c.`blog_id` = b.`id`);
+ALTER TABLE comments ADD KEY `idx_blog_created_at` (`blog_id`, `created_at`);
+
+-- comments.html_content: 写入时渲染好的评论HTML，添加后执行 python3 backfill_comments.py 回填旧评论
+ALTER TABLE comments ADD COLUMN `html_content` mediumtext not null;
@@ -7,164 +7,302 @@ __author__ = 'Jassion Zhao'
 async web application
 '''
 
-import logging; logging.basicConfig(level=logging.INFO)
+import logging
 
-import asyncio, os, json, time
-from datetime import datetime
+import asyncio, os, sys, json, argparse, signal, functools, tempfile
 
-from aiohttp import web
+from config import configs
 
-from jinja2 import Environment, FileSystemLoader
-import orm
-from coroweb import add_routes, add_static
+import applog; applog.init_logging(**configs.logging) # 尽早初始化日志，导入models等模块时的日志也走后台线程
 
-from config import configs
+from aiohttp import web
+
+import orm, prefork, templating, mdrender, timing, metrics, watchdog, cache
+from templating import create_environment, datetime_filter
+from coroweb import add_routes, add_static, singleflight_middleware, etag_response
+from cache import cache_middleware, page_cache
 
 from handlers import cookie2user, COOKIE_NAME
 
-# jinja2是模板引擎，主要是对模板的配置和使用
+# jinja2是模板引擎，主要是对模板的配置和使用，生产模式见templating.py
 def init_jinja2(app, **kw):
     logging.info('init jinja2...')
-    options = dict(
-        autoescape = kw.get('autoescape', True),
-        block_start_string = kw.get('block_start_string', '{%'),
-        block_end_string = kw.get('block_end_string', '%}'),
-        variable_start_string = kw.get('variable_start_string', '{{'),
-        variable_end_string = kw.get('variable_end_string', '}}'),
-        auto_reload = kw.get('auto_reload', True)
-    )
-    path = kw.get('path', None)
-    if path is None:
-        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),'templates')
-    logging.info('set jinja2 template path: %s' % path)
-    env = Environment(loader=FileSystemLoader(path), **options)
-    filters = kw.get('filters', None)
-    if filters is not None:
-        for name, f in filters.items():
-            env.filters[name] = f
+    env = create_environment(**kw)
     app['__templating__'] = env # 将配置好的模板使用环境传给app的'__templating__'属性
 
-@asyncio.coroutine
-def logger_factory(app, handler):
-    @asyncio.coroutine
-    def logger(request):
-        logging.info('Request: %s %s' % (request.method, request.path))
-        # await asyncio.sleep(0.3)
-        return (yield from handler(request))
-    return logger
-
-@asyncio.coroutine
-def data_factory(app, handler):
-    @asyncio.coroutine
-    def parse_data(request): # 解析request，将解析得到的数据放在request的__data__属性中
-        if request.method == 'POST':
-            if request.content_type.startswith('application/json'): # 若request的content_type是json，则用request.json()来解析
-                request.__data__ = yield from request.json()
-                logging.info('request json: %s' % str(request.__data__))
-            elif request.content_type.startswith('application/x-www-form-urlencoded'): # 若request的content_type是x-www-form-urlencoded，则用request.post()来解析
-                request.__data__ = yield from request.post()
-                logging.info('request form: %s' % str(request.__data__))
-        return (yield from handler(request))
-    return parse_data
+access_logger = logging.getLogger('access')
+auth_logger = logging.getLogger('auth')
 
+# 每个请求只在结束时输出一行key=value格式的访问日志，包括请求id(rid)和各阶段的耗时（见timing.py）
+@web.middleware
+async def logger_middleware(request, handler):
+    t = timing.start(request.headers.get('X-Request-Id')) # nginx可以用proxy_set_header X-Request-Id $request_id传入
+    request.__timing__ = t # watchdog从事件循环线程的调用栈上找到request后，用它输出rid
+    status = 500
+    try:
+        r = await handler(request)
+        status = getattr(r, 'status', 200)
+        if isinstance(r, web.StreamResponse) and not r.prepared: # 流式响应的头已经发送，不能再添加
+            r.headers['X-Request-Id'] = t.request_id
+            user = getattr(request, '__user__', None)
+            if configs.timing.header or (user is not None and user.admin):
+                r.headers['Server-Timing'] = t.header()
+        return r
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        if access_logger.isEnabledFor(logging.INFO):
+            user = getattr(request, '__user__', None)
+            access_logger.info('rid=%s method=%s path=%s status=%s ms=%.1f user=%s %s',
+                t.request_id, request.method, request.path, status, t.elapsed() * 1000, user.id if user else '-', t.log_fields())
+
+'''
+流式渲染：用jinja2的generate()逐段生成页面，攒够_STREAM_CHUNK_SIZE个字符就通过chunked编码发送出去，
+不需要在内存中保存整个页面（以及它编码后的副本），浏览器也能更早收到第一个字节。
+流式响应没有body，不会被计算ETag，也不会进入页面缓存。
+HTTP/1.0不支持chunked编码（nginx默认用HTTP/1.0转发请求），这时不发送Content-Length，
+逐段写出后关闭连接，由连接关闭标记响应结束。
 '''
-response_factory生成响应response，并返回，交给aiohttp server去发送给请求者
+_STREAM_CHUNK_SIZE = 16 * 1024
+
+def timing_iter(name, it):
+    ' iterate it, the time spent in next() is measured as span name (writes of the stream excluded). '
+    it = iter(it)
+    while True:
+        with timing.span(name):
+            try:
+                s = next(it)
+            except StopIteration:
+                return
+        yield s
+
+async def stream_template(request, template, context):
+    resp = web.StreamResponse()
+    resp.content_type = 'text/html'
+    resp.charset = 'utf-8'
+    if request.version >= (1, 1):
+        resp.enable_chunked_encoding()
+    else:
+        resp.force_close()
+    await resp.prepare(request)
+    buf, size = [], 0
+    for s in timing_iter('tpl', template.generate(**context)):
+        buf.append(s)
+        size += len(s)
+        if size >= _STREAM_CHUNK_SIZE:
+            await resp.write(''.join(buf).encode('utf-8'))
+            buf, size = [], 0
+    if buf:
+        await resp.write(''.join(buf).encode('utf-8'))
+    await resp.write_eof()
+    return resp
+
+'''
+response_middleware生成响应response，并返回，交给aiohttp server去发送给请求者
 根据 handler(request)返回的结果来判断如何生成需要的响应response
 '''
-@asyncio.coroutine
-def response_factory(app, handler):
-    @asyncio.coroutine
-    def response(request):
-        logging.info('Response handler...')
-        r = yield from handler(request)
-        if isinstance(r, web.StreamResponse):
-            return r
-        if isinstance(r, bytes):
-            resp = web.Response(body=r)
-            resp.content_type = 'application/octet-stream'
-            return resp
-        if isinstance(r, str):
-            if r.startswith('redirect:'):
-                return web.HTTPFound(r[9:])
-            resp = web.Response(body=r.encode('utf-8'))
-            resp.content_type = 'text/html;charset=utf-8'
-            return resp
-        if isinstance(r, dict): # 主要返回的大部分是dict，执行该项
-            template = r.get('__template__') # 获取handler返回的dict中的__template__属性
-            if template is None:
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
-                resp.content_type = 'application/json;charset=utf-8'
-                return resp
-            else:
-                r['__user__'] = request.__user__
-                resp = web.Response(body=app['__templating__'].get_template(template).render(**r).encode('utf-8')) # 从配置好的template环境中获取对应的template
-                resp.content_type = 'text/html;charset=utf-8' # jinja2的Environment对象通过get_template(template)获取一个具体的模板文件，
-                return resp      # 模板文件通过.render(params)接收参数，并且对模板进行渲染，这里的渲染就是将模板中对应的变量根据传入的参数进行赋值处理成静态的html文件
-        if isinstance(r, int) and r >= 100 and r < 600:
-            return web.Response(r)
-        if isinstance(r, tuple) and len(r) == 2:
-            t, m = r
-            if isinstance(t, int) and t >= 100 and t < 600:
-                return web.Response(t, str(m))
-        # default: 将r当作str处理
-        resp = web.Response(body=str(r).encode('utf-8'))
-        resp.content_type = 'text/plain;charset=utf-8'
+@web.middleware
+async def response_middleware(request, handler):
+    r = await handler(request)
+    if isinstance(r, web.StreamResponse):
+        return r
+    if isinstance(r, bytes):
+        resp = web.Response(body=r)
+        resp.content_type = 'application/octet-stream'
         return resp
-    return response
-
-def datetime_filter(t):
-    delta = int(time.time() - t)
-    if delta < 60:
-        return u'1分钟前'
-    if delta < 60*60:
-        return u'%s分钟前' % (delta // 60)
-    if delta < 60*60*24:
-        return u'%s小时前' % (delta // (60*60))
-    if delta < 60*60*24*365:
-        return u'%s天前' % (delta // (60*60*24))
-    dt = datetime.fromtimestamp(t)
-    return u'%s年%s月%s日' % (dt.year, dt.month, dt.day)
+    if isinstance(r, str):
+        if r.startswith('redirect:'):
+            return web.HTTPFound(r[9:])
+        resp = web.Response(body=r.encode('utf-8'))
+        resp.content_type = 'text/html;charset=utf-8'
+        return etag_response(request, resp)
+    if isinstance(r, dict): # 主要返回的大部分是dict，执行该项
+        template = r.get('__template__') # 获取handler返回的dict中的__template__属性
+        if template is None:
+            resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
+            resp.content_type = 'application/json;charset=utf-8'
+            return etag_response(request, resp) # GET请求带上ETag，客户端缓存有效时返回304
+        else:
+            r['__user__'] = request.__user__
+            if r.get('__stream__'): # handler返回'__stream__': True时边渲染边发送，适用于很大的页面
+                return await stream_template(request, request.app['__templating__'].get_template(template), r)
+            with timing.span('tpl'):
+                body = request.app['__templating__'].get_template(template).render(**r).encode('utf-8')
+            resp = web.Response(body=body) # 从配置好的template环境中获取对应的template
+            resp.content_type = 'text/html;charset=utf-8' # jinja2的Environment对象通过get_template(template)获取一个具体的模板文件，
+            return etag_response(request, resp)      # 模板文件通过.render(params)接收参数，并且对模板进行渲染，这里的渲染就是将模板中对应的变量根据传入的参数进行赋值处理成静态的html文件
+    if isinstance(r, int) and r >= 100 and r < 600:
+        return web.Response(status=r)
+    if isinstance(r, tuple) and len(r) == 2:
+        t, m = r
+        if isinstance(t, int) and t >= 100 and t < 600:
+            return web.Response(status=t, text=str(m))
+    # default: 将r当作str处理
+    resp = web.Response(body=str(r).encode('utf-8'))
+    resp.content_type = 'text/plain;charset=utf-8'
+    return resp
 
 # 利用middle在处理URL之前，把cookie解析出来，
 # 并将登录用户绑定到request对象上，这样，后续的URL处理函数就可以直接拿到登录用户
-@asyncio.coroutine
-def auth_factory(app, handler):
-    @asyncio.coroutine
-    def auth(request):
-        logging.info('check user: %s %s' % (request.method, request.path))
-        request.__user__ = None
-        cookie_str = request.cookies.get(COOKIE_NAME) # 从request的cookie中获取名称是COOKIE_NAME的cookie
-        if cookie_str:
-            user = yield from cookie2user(cookie_str) # 从cookie中解析user出来
-            if user:
-                logging.info('set current user: %s' % user.email) # cookie中保存的当前user，将其放在request的__user__属性中，位之后使用
-                request.__user__ = user # 将当前user绑定到request上
-        if request.path.startswith('/manage/') and (request.__user__ is None or not request.__user__.admin):
-            return web.HTTPFound('/signin') # 若是访问的路径是/manage/，且__user__是空（空的cookie），或者__user__不是admin，则跳转到登录页/signin
-        return (yield from handler(request)) # handler 验证cookie之后的request，会去自动调用相应path的handler函数
-    return auth
+@web.middleware
+async def auth_middleware(request, handler):
+    auth_logger.info('check user: %s %s', request.method, request.path)
+    request.__user__ = None
+    cookie_str = request.cookies.get(COOKIE_NAME) # 从request的cookie中获取名称是COOKIE_NAME的cookie
+    if cookie_str:
+        with timing.span('auth'):
+            user = await cookie2user(cookie_str) # 从cookie中解析user出来
+        if user:
+            auth_logger.info('set current user: %s', user.email) # cookie中保存的当前user，将其放在request的__user__属性中，位之后使用
+            request.__user__ = user # 将当前user绑定到request上
+    if request.path.startswith('/manage/') and (request.__user__ is None or not request.__user__.admin):
+        return web.HTTPFound('/signin') # 若是访问的路径是/manage/，且__user__是空（空的cookie），或者__user__不是admin，则跳转到登录页/signin
+    return await handler(request) # handler 验证cookie之后的request，会去自动调用相应path的handler函数
+
+# 导出时才读取的统计：页面缓存命中率 = hit / (hit + stale + miss)，数据库连接池的使用情况
+metrics.registry.callback('counter', 'page_cache_requests_total', 'Page cache lookups by result.',
+    lambda: {('hit',): page_cache.hits, ('stale',): page_cache.stale_hits, ('miss',): page_cache.misses}, ('result',))
+metrics.registry.callback('gauge', 'page_cache_entries', 'Entries in the page cache.', lambda: len(page_cache))
+metrics.registry.callback('gauge', 'db_pool_connections', 'Database connections: size (opened), free (idle) and max.',
+    lambda: {(k,): v for k, v in orm.pool_stats().items()}, ('state',))
 
 def index(request):
     return web.Response(body=b'<h1>Awesome</h1>', content_type='text/html')
 
 
-@asyncio.coroutine
-def init(loop):
-    yield from orm.create_pool(loop=loop, **configs.db)
-    app = web.Application(loop=loop, middlewares=[
-        logger_factory,
-        auth_factory,
-        response_factory
+def create_app():
+    '''
+    Create the web application: middlewares, templates, routes and static files.
+    '''
+    app = web.Application(middlewares=[
+        logger_middleware,
+        metrics.metrics_middleware,
+        auth_middleware,
+        cache_middleware,
+        singleflight_middleware,
+        response_middleware
     ])
-    init_jinja2(app, filters=dict(datetime=datetime_filter))
+    init_jinja2(app, filters=dict(datetime=datetime_filter), **configs.jinja2)
     add_routes(app, 'handlers')
     add_static(app)
-    srv = yield from loop.create_server(app.make_handler(), '127.0.0.1', 9000)
-    logging.info('server started at http://127.0.0.1:9000...')
-    return srv
+    app.router.add_get('/metrics', metrics.metrics_handler) # 只允许本机访问，见conf/nginx/jsnwebapp
+    metrics.setup(app)
+    if configs.watchdog.enabled:
+        watchdog.setup(app, configs.watchdog.interval, configs.watchdog.threshold)
+    return app
+
+def preload(app):
+    '''
+    Warm up everything which can be shared by forked workers: templates and markdown converters.
+    '''
+    names = templating.preload(app['__templating__'])
+    mdrender.markdown('# warm up\n\n```python\npass\n```\n', extras=configs.markdown.extras) # 创建日志正文的转换器，加载pygments的lexer
+    logging.info('preloaded %s templates.' % len(names))
+
+def pool_config(workers=1):
+    '''
+    Database config of one worker, connections of all workers stay within configs.db.maxsize.
+    '''
+    db = dict(configs.db)
+    db['maxsize'] = max(1, configs.db.maxsize // workers)
+    db['minsize'] = min(configs.db.minsize, db['maxsize'])
+    return db
+
+async def init(loop, sock=None, workers=1, app=None):
+    await orm.create_pool(loop=loop, **pool_config(workers))
+    if app is None:
+        app = create_app()
+    app['__state__'] = dict(ready=False) # readiness，见handlers.api_ready；app启动后不能再修改，所以放在可变的dict中
+    runner = web.AppRunner(app, access_log=None, shutdown_timeout=configs.server.shutdown_timeout) # 访问日志由logger_middleware输出
+    await runner.setup()
+    if sock is None:
+        site = web.TCPSite(runner, configs.server.host, configs.server.port)
+    else: # Unix domain socket，或多进程时master创建（或worker用SO_REUSEPORT绑定）的socket
+        site = web.SockSite(runner, sock)
+    await site.start()
+    app['__state__']['ready'] = True
+    logging.info('server started at %s...' % site.name)
+    return runner
+
+async def shutdown(runner):
+    '''
+    Graceful shutdown: stop accepting, wait for in-flight requests (at most shutdown_timeout), then close the database pool.
+    '''
+    runner.app['__state__']['ready'] = False
+    logging.info('draining requests...')
+    await runner.cleanup()
+    await orm.destroy_pool()
+    logging.info('server stopped.')
+
+def run(sock=None, workers=1, app=None):
+    '''
+    Run one server process until SIGTERM or SIGINT.
+    '''
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    runner = loop.run_until_complete(init(loop, sock, workers, app))
+    prefork.notify_ready()
+    stop_signals = (signal.SIGTERM, signal.SIGINT) if workers > 1 else (signal.SIGTERM, signal.SIGINT, signal.SIGHUP) # 单进程时SIGHUP也是平滑退出，由supervisor重新启动
+    for sig in stop_signals:
+        loop.add_signal_handler(sig, loop.stop)
+    try:
+        loop.run_forever()
+    finally:
+        loop.run_until_complete(shutdown(runner))
+        loop.close()
 
-loop = asyncio.get_event_loop()
-loop.run_until_complete(init(loop))
-loop.run_forever()
+def run_worker(app, workers, worker_id, sock):
+    signal.signal(signal.SIGHUP, signal.SIG_IGN) # reload由master处理
+    if sock is None and configs.server.unix: # 每个worker一个socket文件
+        sock = prefork.bind_unix_socket(configs.server.unix.format(worker=worker_id))
+    elif sock is None: # reuse_port：每个worker各自绑定
+        sock = prefork.bind_socket(configs.server.host, configs.server.port, reuse_port=True)
+    logging.info('worker %s (pid %s) serving.' % (worker_id, os.getpid()))
+    run(sock, workers, app)
 
+def install_uvloop():
+    '''
+    Use uvloop as the event loop if it is installed.
+    '''
+    try:
+        import uvloop
+    except ImportError:
+        logging.warning('uvloop is not installed, use asyncio event loop.')
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    logging.info('use uvloop event loop.')
+    return True
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='awesome web app')
+    parser.add_argument('--uvloop', action='store_true', default=configs.server.uvloop, help='run on uvloop')
+    parser.add_argument('--workers', type=int, default=configs.server.workers, help='number of worker processes, 0 for cpu count')
+    parser.add_argument('--unix', default=configs.server.unix, help='listen on unix domain socket instead of host:port, {worker} is replaced by worker id')
+    parser.add_argument('--check', action='store_true', help='load the app and exit, used before reload')
+    args = parser.parse_args()
+    configs.server.unix = args.unix
+    if args.check:
+        preload(create_app())
+        sys.exit(0)
+    if args.uvloop:
+        install_uvloop()
+    workers = args.workers or prefork.cpu_count()
+    if workers == 1:
+        run(prefork.bind_unix_socket(args.unix.format(worker=0)) if args.unix else None)
+    else:
+        app = create_app() # 在master中创建好app并预热，fork后由所有worker共享
+        preload(app)
+        sock, old_pids = prefork.inherited() # reload后由旧master传过来
+        metrics.init(configs.metrics.dir or os.path.join(tempfile.gettempdir(), 'jsnwebapp-metrics-%s' % configs.server.port),
+                     configs.metrics.interval, clear=not old_pids) # reload时保留旧worker的计数
+        cache.share(configs.cache.stamps or os.path.join(tempfile.gettempdir(), 'jsnwebapp-cache-%s.stamps' % configs.server.port))
+        if sock is None and args.unix:
+            if '{worker}' not in args.unix: # 所有worker共享一个socket文件
+                sock = prefork.bind_unix_socket(args.unix)
+        elif sock is None and not configs.server.reuse_port:
+            sock = prefork.bind_socket(configs.server.host, configs.server.port)
+        prefork.Master(functools.partial(run_worker, app, workers), workers, sock,
+                       stop_timeout=configs.server.shutdown_timeout + 5,
+                       check=[sys.executable] + sys.argv + ['--check'],
+                       old_pids=old_pids).run()
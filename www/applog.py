@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jassion Zhao'
+
+'''
+logging setup.
+
+所有logger都只往一个队列里放LogRecord，由后台线程(QueueListener)负责格式化并写到stdout，
+请求处理的协程不会因为写日志而阻塞；当前线程只把msg和args合并成字符串，按format格式化留给后台线程。
+
+每个模块使用自己的分类logger（如 'orm', 'coroweb', 'access'），可以在configs.logging中
+为每个分类单独设置级别(levels)和采样率(sample)。
+'''
+
+import logging, logging.handlers, queue, random, os, sys, atexit, copy
+
+_DEFAULT_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+_listener = None
+_exc_formatter = logging.Formatter()
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    '''
+    QueueHandler that leaves formatting to the listener thread.
+    '''
+    def prepare(self, record):
+        # 默认的prepare会在当前线程调用format()，这里只把msg % args合并成字符串：
+        # args可能是可变对象，后台线程格式化时它们可能已经被修改；时间、级别等其他字段留给后台线程格式化。
+        # prepare只在级别和filter都通过之后才会被调用，被采样丢弃的日志不会有这个开销
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text: # traceback引用着调用栈的frame，也在当前线程格式化
+                record.exc_text = _exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+class SampleFilter(logging.Filter):
+    '''
+    Keep only a fraction of records below WARNING. Warnings and errors are never dropped.
+    '''
+    def __init__(self, rate):
+        super(SampleFilter, self).__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or self.rate >= 1.0:
+            return True
+        return random.random() < self.rate
+
+def init_logging(level='INFO', levels=None, sample=None, format=_DEFAULT_FORMAT, stream=None):
+    '''
+    Install queue based logging on root logger.
+
+    levels: dict of category name => level, e.g. {'orm': 'WARNING'}
+    sample: dict of category name => sample rate between 0 and 1, e.g. {'access': 0.1}
+    '''
+    global _listener
+    if _listener is not None:
+        return
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(logging.Formatter(format))
+    q = queue.Queue(-1)
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(LazyQueueHandler(q))
+    root.setLevel(level)
+    for name, lv in (levels or {}).items():
+        logging.getLogger(name).setLevel(lv)
+    for name, rate in (sample or {}).items():
+        logging.getLogger(name).addFilter(SampleFilter(rate))
+    _listener = logging.handlers.QueueListener(q, handler)
+    _listener.start()
+    atexit.register(stop_logging)
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(before=_before_fork, after_in_parent=_after_fork, after_in_child=_after_fork)
+
+# fork只复制调用fork的线程：后台线程可能正持有stdout等锁，子进程中就没有线程会释放它们了，
+# 所以fork前先停掉后台线程（队列中的日志会先写完），fork后在父子进程中各自重新启动
+def _before_fork():
+    if _listener is not None:
+        _listener.stop()
+
+def _after_fork():
+    if _listener is not None:
+        _listener.start()
+
+def stop_logging():
+    ' flush queued records and stop the writer thread. '
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
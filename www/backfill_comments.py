@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jassion Zhao'
+
+'''
+re-render comments.html_content of all comments.
+
+执行sql_files/upgrade.sql添加html_content字段后运行一次；
+comment2html的渲染规则修改之后（比如修复了过滤不安全HTML的问题），也要再运行一次，
+因为已保存的html_content可能是按旧规则渲染的：
+$ python3 backfill_comments.py
+'''
+
+import asyncio, logging
+
+import orm
+from config import configs
+from models import Comment
+from handlers import comment2html
+
+_BATCH_SIZE = 500
+
+async def backfill(loop, batch_size=_BATCH_SIZE):
+    await orm.create_pool(loop, **configs.db)
+    total = 0
+    last_id = ''
+    try:
+        while True:
+            # 按id分批遍历全部评论（next_id生成的id按时间递增），不依赖html_content是否为空
+            comments = await Comment.findAll('`id`>?', [last_id], orderBy='id', limit=batch_size)
+            if not comments:
+                break
+            for c in comments:
+                c.html_content = comment2html(c.content)
+                await c.update()
+            last_id = comments[-1].id
+            total = total + len(comments)
+            logging.info('%s comments rendered.' % total)
+    finally:
+        await orm.destroy_pool()
+    return total
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.get_event_loop()
+    print('%s comments backfilled.' % loop.run_until_complete(backfill(loop)))
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jassion Zhao'
+
+'''
+markdown benchmark.
+
+用一组接近真实日志的文档（代码块、表格、脚注、长文章、评论）测量Markdown.convert的吞吐量，
+修改markdown2.py或mdrender.py之后运行一次，防止渲染性能退化：
+
+$ python3 bench_markdown.py                      # 打印每类文档的吞吐量
+$ python3 bench_markdown.py --save bench.json    # 保存为基准
+$ python3 bench_markdown.py --baseline bench.json --tolerance 0.2
+                                                 # 比基准慢20%以上时返回非0
+'''
+
+import argparse, json, sys, time
+
+import markdown2
+import mdrender
+
+_EXTRAS = ['fenced-code-blocks', 'tables', 'footnotes']
+
+_PARAGRAPH = '''Python的**asyncio**提供了事件循环、协程和Future，一个线程就可以同时处理成千上万个连接。
+在`aiohttp`中每个请求由一个协程处理，遇到IO时让出CPU，详见[官方文档](https://docs.python.org/3/library/asyncio.html "asyncio")。
+_注意_：不要在协程中调用阻塞的函数，比如`time.sleep()`或者同步的数据库驱动。
+'''
+
+_CODE = '''```python
+async def handler(request):
+    users = await User.findAll(orderBy='created_at desc')
+    for u in users:
+        u.passwd = '******'
+    return dict(users=users)
+```
+'''
+
+_INDENTED_CODE = '''    $ python3 app.py
+    INFO:root:server started at http://127.0.0.1:9000...
+'''
+
+_TABLE = '''| 字段 | 类型 | 说明 |
+|:-----|:----:|-----:|
+| id | varchar(50) | 主键 |
+| name | varchar(50) | 名称 |
+| created_at | real | 创建时间 |
+'''
+
+_LIST = '''1. 安装依赖：`pip3 install aiohttp jinja2 aiomysql`
+2. 初始化数据库：
+    - 执行`schema.sql`
+    - 执行`upgrade.sql`
+3. 启动：`python3 app.py`
+'''
+
+_FOOTNOTE = '''事件循环是单线程的[^1]，CPU密集的任务应该放到进程池中[^2]。
+
+[^1]: 默认的事件循环基于selectors。
+[^2]: 见`loop.run_in_executor()`。
+'''
+
+_QUOTE = '''> 过早的优化是万恶之源。
+>
+> -- Donald Knuth
+'''
+
+def corpus():
+    ' return list of (name, text, extras). '
+    section = '\n'.join([_PARAGRAPH, _CODE, _TABLE, _LIST, _QUOTE, _INDENTED_CODE])
+    long_post = '\n'.join('## 第%s节\n\n%s' % (i, section) for i in range(1, 31))
+    return [
+        ('comment', '写得不错，**收藏**了！参考`asyncio`的文档。\n', None),
+        ('short', '# 标题\n\n' + _PARAGRAPH, None),
+        ('code', _PARAGRAPH + '\n' + _CODE + '\n' + _INDENTED_CODE, _EXTRAS),
+        ('table', _PARAGRAPH + '\n' + _TABLE * 3, _EXTRAS),
+        ('footnote', _FOOTNOTE * 2, _EXTRAS),
+        ('list', _LIST * 5, None),
+        ('long', long_post, _EXTRAS)
+    ]
+
+def _measure(fn, text, seconds):
+    ' run fn(text) repeatedly for about `seconds`, return calls per second. '
+    fn(text) # 预热
+    n = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while True:
+        fn(text)
+        n = n + 1
+        now = time.perf_counter()
+        if now >= deadline:
+            return n / (now - start)
+
+def run(seconds=0.5):
+    ' benchmark every document of the corpus, return dict of name => result. '
+    results = dict()
+    for name, text, extras in corpus():
+        fresh = _measure(lambda t: markdown2.markdown(t, extras=extras), text, seconds)
+        pooled = _measure(lambda t: mdrender.markdown(t, extras=extras), text, seconds)
+        size = len(text.encode('utf-8'))
+        results[name] = dict(bytes=size, fresh=fresh, pooled=pooled, kb_per_sec=pooled * size / 1024)
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='markdown rendering benchmark')
+    parser.add_argument('--seconds', type=float, default=0.5, help='time per document and renderer')
+    parser.add_argument('--save', help='save results as baseline json')
+    parser.add_argument('--baseline', help='compare with baseline json')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown against baseline')
+    args = parser.parse_args(argv)
+    results = run(args.seconds)
+    print('%-10s %8s %12s %12s %10s' % ('doc', 'bytes', 'fresh/s', 'pooled/s', 'KB/s'))
+    for name, r in results.items():
+        print('%-10s %8d %12.1f %12.1f %10.1f' % (name, r['bytes'], r['fresh'], r['pooled'], r['kb_per_sec']))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        slower = [(name, baseline[name]['pooled'], r['pooled']) for name, r in results.items()
+                  if name in baseline and r['pooled'] < baseline[name]['pooled'] * (1 - args.tolerance)]
+        for name, old, new in slower:
+            print('REGRESSION %s: %.1f/s -> %.1f/s' % (name, old, new))
+        return 1 if slower else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
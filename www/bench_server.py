@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jassion Zhao'
+
+'''
+HTTP load generator for measuring request throughput of the running server.
+
+$ python3 app.py                 # 或 python3 app.py --uvloop
+$ python3 bench_server.py http://127.0.0.1:9000/api/blogs --concurrency 50 --seconds 10
+
+每个并发连接循环发送请求，结束后打印每秒请求数和延迟分布（p50/p90/p99）。
+
+对比nginx到app的几种连接方式（app.py --unix /tmp/app.sock 监听Unix domain socket）：
+$ python3 bench_server.py http://127.0.0.1:9000/api/blogs --close     # 每个请求新建TCP连接（nginx没有配置keepalive时）
+$ python3 bench_server.py http://127.0.0.1:9000/api/blogs             # TCP长连接
+$ python3 bench_server.py http://localhost/api/blogs --unix /tmp/app.sock
+'''
+
+import argparse, asyncio, sys, time
+
+import aiohttp
+
+async def _worker(session, url, deadline, latencies, errors):
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            async with session.get(url) as resp:
+                await resp.read()
+                if resp.status >= 400:
+                    errors.append(resp.status)
+        except aiohttp.ClientError as e:
+            errors.append(str(e))
+        latencies.append(time.perf_counter() - start)
+
+async def run(url, concurrency=50, seconds=10.0, warmup=1.0, unix=None, close=False):
+    ' return dict of requests, errors, rps, p50, p90, p99 (ms). '
+    if unix:
+        connector = aiohttp.UnixConnector(path=unix, limit=concurrency, force_close=close)
+    else:
+        connector = aiohttp.TCPConnector(limit=concurrency, force_close=close)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        if warmup > 0: # 预热：建立连接、填充缓存
+            await asyncio.gather(*[_worker(session, url, time.perf_counter() + warmup, [], []) for i in range(concurrency)])
+        latencies, errors = [], []
+        start = time.perf_counter()
+        await asyncio.gather(*[_worker(session, url, start + seconds, latencies, errors) for i in range(concurrency)])
+        elapsed = time.perf_counter() - start
+    latencies.sort()
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else 0.0
+    return dict(requests=len(latencies), errors=len(errors), rps=len(latencies) / elapsed, p50=pct(0.5), p90=pct(0.9), p99=pct(0.99))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='HTTP load generator')
+    parser.add_argument('url')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--warmup', type=float, default=1.0)
+    parser.add_argument('--unix', help='connect to unix domain socket')
+    parser.add_argument('--close', action='store_true', help='new connection for every request')
+    args = parser.parse_args(argv)
+    r = asyncio.run(run(args.url, args.concurrency, args.seconds, args.warmup, args.unix, args.close))
+    print('%(requests)d requests, %(errors)d errors, %(rps).1f req/s, p50 %(p50).2fms p90 %(p90).2fms p99 %(p99).2fms' % r)
+    return 1 if r['errors'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
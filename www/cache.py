@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jassion Zhao'
+
+'''
+in-process response cache.
+
+对匿名用户来说，首页、日志页面和公开的JSON API对所有人都是一样的，没必要每次都查询数据库、渲染模板。
+
+@cached(ttl, tags)与@get配合使用，cache_middleware是middleware，需要放在auth_middleware之后、response_middleware之前：
+
+app = web.Application(middlewares=[
+    logger_middleware, auth_middleware, cache_middleware, singleflight_middleware, response_middleware
+])
+
+缓存的是最终编码好的Response body，key是path加上排序后的query参数；
+已登录用户的请求不走缓存，除非handler指定了vary_on_user=True(此时key中包含用户id)。
+tags可以引用URL参数，如'blog:{id}'，写操作通过invalidate('blog:xxx')让相关的缓存失效。
+
+stale-while-revalidate：每个缓存项有软、硬两个过期时间(ttl和ttl+stale)。
+超过软过期时间后仍然立即返回旧的内容，同时只启动一个后台任务重新生成；超过硬过期时间才必须等待重新生成。
+为了避免大量key同时过期，按XFetch算法根据重新生成的耗时提前随机地认为缓存项已经过期。
+
+多进程（见prefork.py）时每个worker有自己的缓存，写操作只在处理它的worker中执行，
+所以invalidate()同时把tags对应的计数器加1，计数器在所有worker共享的mmap(TagStamps)中：
+每个缓存项记下开始生成时它的tags的计数器，命中时计数器变了就当作未命中（也不会再作为旧内容返回）。
+master在fork之前用share()把计数器放到文件中，reload时新旧worker也使用同一份计数器。
+'''
+
+import asyncio, collections, logging, math, mmap, os, random, struct, time, zlib
+from email.utils import parsedate_to_datetime
+
+from aiohttp import web
+from multidict import CIMultiDict
+
+from config import configs
+from coroweb import not_modified, not_modified_response
+
+_logger = logging.getLogger('cache')
+
+class TagStamps(object):
+    '''
+    Invalidation counters of tags in a shared mmap, each tag is hashed into one of `slots` 8-byte counters.
+    Anonymous mapping is shared with processes forked later, a file mapping (path) also with other process trees.
+    '''
+    def __init__(self, slots=4096, path=None):
+        self.slots = slots
+        size = slots * 8
+        if path is None:
+            self._map = mmap.mmap(-1, size)
+        else:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                if os.fstat(fd).st_size < size:
+                    os.ftruncate(fd, size) # 新文件全部为0，已有的计数器保留
+                self._map = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+
+    def slots_of(self, tags):
+        # hash()在不同的进程中不一样，用crc32；冲突只会多失效一些缓存项
+        return tuple(sorted(set(zlib.crc32(t.encode('utf-8')) % self.slots for t in tags)))
+
+    def read(self, slots):
+        return tuple(struct.unpack_from('<Q', self._map, i * 8)[0] for i in slots)
+
+    def bump(self, tags):
+        # 不同进程同时加1可能丢失一次，但值总是变了，足以让缓存项失效
+        for i in self.slots_of(tags):
+            struct.pack_into('<Q', self._map, i * 8, (struct.unpack_from('<Q', self._map, i * 8)[0] + 1) & 0xffffffffffffffff)
+
+class TTLCache(object):
+    '''
+    LRU cache with soft and hard ttl, entries can be invalidated by tags.
+
+    get() returns (value, fresh): fresh is False when the entry is past its soft ttl
+    (or is chosen to expire early), the caller should serve it and refresh in background.
+    '''
+    def __init__(self, size=1000, beta=1.0, stamps=None):
+        self.size = size
+        self.beta = beta # 提前过期的力度，0表示不提前
+        self.stamps = stamps # TagStamps，其他进程invalidate的tags
+        self._data = collections.OrderedDict() # key => (soft_expires, hard_expires, delta, tags, stamp, value)
+        self.generation = 0 # 每次invalidate加1，生成期间发生过invalidate的结果不写入缓存
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        item = self._data.get(key)
+        now = time.time()
+        if item is None or item[1] < now:
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return None, False
+        soft, hard, delta, tags, stamp, value = item
+        if stamp is not None and self.stamps.read(stamp[0]) != stamp[1]: # 其他worker invalidate过它的tags
+            del self._data[key]
+            self.misses += 1
+            return None, False
+        self._data.move_to_end(key)
+        # XFetch: 重新生成耗时(delta)越长，越早被认为过期，-log(random())服从指数分布
+        fresh = now - delta * self.beta * math.log(1.0 - random.random()) < soft
+        if fresh:
+            self.hits += 1
+        else:
+            self.stale_hits += 1
+        return value, fresh
+
+    def stamp(self, tags):
+        ' counters of tags, taken before generating the value and passed to set(). '
+        if self.stamps is None or not tags:
+            return None
+        slots = self.stamps.slots_of(tags)
+        return slots, self.stamps.read(slots)
+
+    def set(self, key, value, ttl, stale=0, tags=(), delta=0.0, generation=None, stamp=None):
+        if generation is not None and generation != self.generation:
+            return False
+        now = time.time()
+        self._data[key] = (now + ttl, now + ttl + stale, delta, frozenset(tags), stamp, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.size:
+            self._data.popitem(last=False)
+        return True
+
+    def invalidate(self, *tags):
+        ' remove all entries having any of the tags. '
+        tags = set(tags)
+        self.generation += 1
+        if self.stamps is not None:
+            self.stamps.bump(tags)
+        for key in [k for k, item in self._data.items() if item[3] & tags]:
+            del self._data[key]
+
+    def clear(self):
+        self.generation += 1
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+page_cache = TTLCache(configs.cache.size, configs.cache.beta, TagStamps())
+
+def share(path):
+    '''
+    Keep the invalidation counters in file path, called by the master before forking workers,
+    so workers of the old and new master share them during reload.
+    '''
+    page_cache.stamps = TagStamps(path=path)
+
+def cached(ttl=60, stale=0, tags=(), vary_on_user=False):
+    '''
+    Define decorator @cached(ttl, stale, tags): cache the final response of GET handler for ttl seconds,
+    then serve it stale for at most another `stale` seconds while refreshing in background.
+    '''
+    def decorator(func):
+        func.__cache__ = dict(ttl=ttl, stale=stale, tags=tuple(tags), vary_on_user=vary_on_user)
+        return func
+    return decorator
+
+def invalidate(*tags):
+    ' called by write handlers, e.g. invalidate(\'blogs\', \'blog:%s\' % id). '
+    page_cache.invalidate(*tags)
+
+def _cacheable(r):
+    return isinstance(r, web.Response) and r.status == 200 and isinstance(r.body, bytes) and 'Set-Cookie' not in r.headers
+
+_CONDITIONAL_HEADERS = ('if-none-match', 'if-modified-since')
+
+_refreshing = set() # 正在后台重新生成的key，保证每个key只有一个刷新任务
+
+async def _generate(handler, request, key, options):
+    generation = page_cache.generation
+    tags = [t.format(**request.match_info) for t in options['tags']]
+    stamp = page_cache.stamp(tags) # 生成期间其他worker的invalidate也会让这个结果失效
+    start = time.time()
+    r = await handler(request)
+    if _cacheable(r):
+        page_cache.set(key, (r.body, r.status, r.headers.copy()), options['ttl'], options['stale'], tags, time.time() - start, generation, stamp)
+    return r
+
+async def _refresh(handler, request, key, options):
+    try:
+        # 去掉条件请求头，否则可能得到无法缓存的304
+        headers = CIMultiDict((k, v) for k, v in request.headers.items() if k.lower() not in _CONDITIONAL_HEADERS)
+        clone = request.clone(headers=headers)
+        clone.__user__ = request.__user__
+        await _generate(handler, clone, key, options)
+    except Exception as e:
+        _logger.exception('refresh %s failed', request.path_qs)
+    finally:
+        _refreshing.discard(key)
+
+def _last_modified(headers):
+    ' return timestamp of the cached Last-Modified header, or None. '
+    value = headers.get('Last-Modified')
+    if value is None:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+@web.middleware
+async def cache_middleware(request, handler):
+    options = getattr(request.match_info.handler, '__cache__', None)
+    if options is None or not configs.cache.enabled or request.method != 'GET':
+        return await handler(request)
+    user = request.__user__
+    if user is not None and not options['vary_on_user']: # 带session cookie的请求不走缓存
+        return await handler(request)
+    key = (request.path, tuple(sorted(request.query.items())), user.id if user else None)
+    entry, fresh = page_cache.get(key)
+    if entry is not None:
+        if not fresh and key not in _refreshing: # 先返回旧内容，后台刷新
+            _refreshing.add(key)
+            asyncio.ensure_future(_refresh(handler, request, key, options))
+        body, status, headers = entry
+        etag, last_modified = headers.get('ETag'), _last_modified(headers)
+        if not_modified(request, etag, last_modified):
+            return not_modified_response(etag, last_modified)
+        return web.Response(body=body, status=status, headers=headers)
+    return await _generate(handler, request, key, options)
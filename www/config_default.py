@@ -9,13 +9,75 @@ default configuration
 configs = {
     'debug': True,
     'db': {
+        'driver': 'mysql', # mysql 或 sqlite，sqlite时database为数据库文件路径
         'host': '127.0.0.1',
         'port': 3308,
         'user': 'www-data',
         'password': 'www-data',
-        'database': 'db_web'
+        'database': 'db_web',
+        'maxsize': 10, # 所有worker进程的连接数之和，多进程时每个worker的连接池大小为maxsize // workers
+        'minsize': 1
+    },
+    'server': {
+        'host': '127.0.0.1',
+        'port': 9000,
+        'uvloop': False, # 安装了uvloop时可以设为True（或启动时加--uvloop），用uvloop替换asyncio默认的事件循环
+        'workers': 0,    # worker进程数（或启动时加--workers N），0表示CPU核数，1表示不fork、单进程运行，见prefork.py
+                         # 每个worker有自己的页面缓存，写操作的invalidate通过共享的计数器让所有worker的缓存失效，见cache.py
+        'reuse_port': False, # 多进程时每个worker用SO_REUSEPORT各自绑定端口，由内核分配连接；False时共享master创建的socket
+        'shutdown_timeout': 25, # 单位秒，退出时停止accept后，等待进行中的请求完成的最长时间
+        'unix': '' # Unix domain socket路径（或启动时加--unix），设置后不再监听host:port；路径中有{worker}时每个worker一个socket
     },
     'session': {
         'secret': 'jAsSIoN'
+    },
+    'jinja2': {
+        'production': False,         # 生产环境设为True：关闭auto_reload，使用预编译模板和bytecode cache
+        'bytecode_cache': '',        # bytecode cache目录，''表示使用jinja2默认的临时目录
+        'compiled_path': 'templates_compiled' # fab build时预编译模板的输出目录，相对www目录
+    },
+    'markdown': {
+        'extras': ['fenced-code-blocks', 'tables'] # 日志正文使用的markdown2 extras，安装了pygments时```代码块会高亮
+    },
+    'ssr': True, # 列表页面在服务端查询第一页数据并嵌入模板，浏览器不需要再请求一次API
+    'cache': {
+        'enabled': True, # 匿名用户页面的响应缓存，见cache.py
+        'size': 1000,    # 最多缓存多少个响应
+        'beta': 1.0,     # 缓存项提前随机过期的力度，0表示只在ttl到期时刷新
+        'stamps': ''     # 多进程时各worker共享的失效计数器文件，''表示系统临时目录下的jsnwebapp-cache-<port>.stamps
+    },
+    'slowquery': {
+        'threshold': 0.2, # 单位秒，耗时超过该值的SQL会被记录，None表示关闭
+        'size': 100,      # 最多保留最近的多少条慢查询
+        'explain': True   # 对每种新的慢查询执行一次EXPLAIN
+    },
+    'querystats': {
+        'enabled': True,  # 按SQL形状累计统计，见/manage/api/querystats
+        'samples': 200    # 每种SQL保留最近多少次耗时用于计算p95
+    },
+    'timing': {
+        'header': False # 是否给所有用户的响应加上Server-Timing头，False时只有管理员能看到；访问日志中总是记录各阶段耗时
+    },
+    'metrics': {
+        'dir': '',     # 多进程时各worker写入统计数据的目录，''表示系统临时目录下的jsnwebapp-metrics，见metrics.py
+        'interval': 5  # 单位秒，worker写入统计数据的间隔，/metrics中其他worker的数据最多延迟这么久
+    },
+    'watchdog': {
+        'enabled': True,  # 监测事件循环被同步代码阻塞的情况，见watchdog.py
+        'interval': 0.1,  # 单位秒，心跳间隔
+        'threshold': 0.2  # 单位秒，loop lag超过该值时输出调用栈
+    },
+    'logging': {
+        'level': 'INFO',
+        'levels': { # 各分类logger的级别
+            'access': 'INFO',    # 每个请求一行的访问日志
+            'auth': 'WARNING',
+            'coroweb': 'WARNING',
+            'orm': 'WARNING'
+        },
+        'sample': { # 各分类logger的采样率，WARNING及以上的日志不会被丢弃
+            'access': 1.0,
+            'orm': 1.0
+        }
     }
 }
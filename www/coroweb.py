@@ -15,12 +15,39 @@ a web framework
 # 4. 解析堆栈
 '''
 
-import asyncio, os, inspect, logging, functools
+import asyncio, os, inspect, logging, functools, hashlib, collections
 
-from urllib import parse
 from aiohttp import web
 from apis import APIError
+import timing
 
+_logger = logging.getLogger('coroweb')
+
+def _wraps(func):
+    ' wrapper of func made by functools.wraps, native coroutine functions stay native. '
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kw):
+            return await func(*args, **kw)
+    else:
+        @functools.wraps(func)
+        def wrapper(*args, **kw):
+            return func(*args, **kw)
+    return wrapper
+
+def to_coroutine(fn):
+    '''
+    Wrap plain function as native coroutine function, coroutine functions are returned as is.
+    '''
+    if inspect.iscoroutinefunction(fn):
+        return fn
+    @functools.wraps(fn)
+    async def wrapper(*args, **kw):
+        r = fn(*args, **kw)
+        if inspect.isawaitable(r):
+            r = await r
+        return r
+    return wrapper
 
 # 要把一个函数映射为一个URL处理函数，我们先定义@get()装饰器
 def get(path):
@@ -28,9 +55,7 @@ def get(path):
     Define decorator @get('/path')
     '''
     def decorator(func):
-        @functools.wraps(func)
-        def wrapper(*args, **kw):
-            return func(*args, **kw)
+        wrapper = _wraps(func)
         wrapper.__method__ = 'GET'
         wrapper.__route__ = path
         return wrapper
@@ -48,15 +73,36 @@ def post(path):
     Define decorator @post('/path')
     '''
     def decorator(func):
-        @functools.wraps(func)
-        def wrapper(*args, **kw):
-            return func(*args, **kw)
+        wrapper = _wraps(func)
         wrapper.__method__ = 'POST'
         wrapper.__route__ = path
         return wrapper
     return decorator
 
 
+# @singleflight()与@get配合使用：同一时刻相同的匿名GET请求只执行一次handler，其余请求等待并共享结果
+def singleflight(timeout=3.0):
+    '''
+    Define decorator @singleflight(timeout): identical concurrent anonymous GET requests share one execution.
+    Waiters give up after timeout seconds and run the handler by themselves.
+    '''
+    def decorator(func):
+        func.__singleflight__ = timeout
+        return func
+    return decorator
+
+# @conditional(validator)与@get配合使用，支持条件GET(304)：
+# validator是一个协程，接收与handler相同的URL参数，在handler之前执行，返回资源的最后修改时间（时间戳），未知时返回None
+def conditional(validator):
+    '''
+    Define decorator @conditional(validator): answer 304 before calling the handler if client cache is fresh.
+    '''
+    def decorator(func):
+        func.__validator__ = validator
+        return func
+    return decorator
+
+
 # 定义一些RequestHandler需要用到的接口函数,用来处理request（从request获取参数）
 def has_request_arg(fn):
     sig = inspect.signature(fn) # 获取fn的完整参数列表，如：(a, b=0)
@@ -115,6 +161,28 @@ def get_named_kw_args(fn):
             args.append(name)
     return tuple(args)
 
+# 参数的类型注解，如 def api_blogs(*, page: int = 1)，RequestHandler会把字符串参数转换成对应的类型
+_BOOL_VALUES = {'1': True, 'true': True, 'yes': True, 'on': True, '0': False, 'false': False, 'no': False, 'off': False, '': False}
+
+def _to_bool(v):
+    if isinstance(v, bool):
+        return v
+    try:
+        return _BOOL_VALUES[str(v).lower()]
+    except KeyError:
+        raise ValueError('Invalid bool value: %s' % v)
+
+_COERCERS = {int: int, float: float, bool: _to_bool, str: str}
+
+def get_arg_coercers(fn):
+    coercers = dict()
+    params = inspect.signature(fn).parameters
+    for name, param in params.items():
+        coerce = _COERCERS.get(param.annotation)
+        if coerce is not None:
+            coercers[name] = coerce
+    return coercers
+
 
 '''
 定义RequestHandler
@@ -143,59 +211,210 @@ class RequestHandler(object):
         self._has_named_kw_args = has_named_kw_args(fn)
         self._named_kw_args = get_named_kw_args(fn)
         self._required_kw_args = get_required_kw_args(fn)
+        self._coercers = get_arg_coercers(fn)
+        self._bind = self._compile_binder()
+        self.__singleflight__ = getattr(fn, '__singleflight__', None)
+        self.__cache__ = getattr(fn, '__cache__', None)
+        self._validator = getattr(fn, '__validator__', None)
+        if self._validator is not None:
+            self._validator_args = tuple(inspect.signature(self._validator).parameters.keys())
+            self._validator = to_coroutine(self._validator)
+
+    def _compile_binder(self):
+        '''
+        Build the argument binder of this handler once at registration.
+        The binder is a coroutine returning (kw, None), or (None, error response).
+        '''
+        # 把每个请求都要重复判断的条件提前算好，绑定参数时只做这个handler需要的工作
+        named = self._named_kw_args
+        var_kw = self._has_var_kw_arg
+        required = self._required_kw_args
+        has_request = self._has_request_arg
+        coercers = tuple(self._coercers.items())
+
+        def finish(request, kw):
+            if has_request:
+                kw['request'] = request
+            for name in required: # check required kw
+                if name not in kw:
+                    return None, web.HTTPBadRequest(text='Missing argument: %s' % name)
+            for name, coerce in coercers:
+                if name in kw and kw[name] is not None:
+                    try:
+                        kw[name] = coerce(kw[name])
+                    except (TypeError, ValueError):
+                        return None, web.HTTPBadRequest(text='Invalid argument: %s' % name)
+            return kw, None
+
+        if not (var_kw or named):
+            # handler只接收URL中的参数(如get_blog(id))或request，不需要解析query和body
+            async def bind(request):
+                return finish(request, dict(request.match_info))
+            return bind
+
+        if var_kw:
+            def pick(params):
+                return {k: params.get(k) for k in params.keys()} # 重复的key取第一个值
+        else:
+            def pick(params): # 只取handler接受的参数
+                return {name: params[name] for name in named if name in params}
 
-    @asyncio.coroutine
-    def __call__(self, request): # 这个request是什么？哪里传入的？猜测，应该是aiohttp这个server去调用已经注册好了的handler的时候，会把request传进去
-        kw = None
-        if self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args:
+        async def bind(request):
+            kw = None
             if request.method == 'POST':
                 if not request.content_type:
-                    return web.HTTPBadRequest('Missing Content-Type.')
+                    return None, web.HTTPBadRequest(text='Missing Content-Type.')
                 ct = request.content_type.lower()
-                if ct.startswith('application/json'): # 若ct是json
-                    params = yield from request.json()
+                if ct.startswith('application/json'):
+                    params = await request.json()
                     if not isinstance(params, dict):
-                        return web.HTTPBadRequest('JSON body must be object.')
-                    kw = params # kw 就是request转换为json的json
-                elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'): # 若ct是表单form类型
-                    params = yield from request.post() # 通过post方式获取数据
-                    kw = dict(**params)
+                        return None, web.HTTPBadRequest(text='JSON body must be object.')
+                    kw = pick(params)
+                elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
+                    params = await request.post()
+                    kw = pick(params)
                 else:
-                    return web.HTTPBadRequest('Unsupported Content-Type: %s' % request.content_type)
-            if request.method == 'GET':
-                qs = request.query_string
-                if qs:
-                    kw = dict()
-                    for k, v in parse.parse_qs(qs, True).items():
-                        kw[k] = v[0]
-        if kw is None:
-            kw = dict(**request.match_info)
-        else:
-            if not self._has_var_kw_arg and self._named_kw_args:
-                # remove all unamed kw:
-                copy = dict()
-                for name in self._named_kw_args:
-                    if name in kw:
-                        copy[name] = kw[name]
-                kw = copy
-            # check named arg:
-            for k, v in request.match_info.items():
-                if k in kw:
-                    logging.warning('Duplicate arg name in named arg and kw args: %s' % k)
-                kw[k] = v
-        if self._has_request_arg:
-            kw['request'] = request
-        # check required kw:
-        if self._required_kw_args:
-            for name in self._required_kw_args:
-                if not name in kw:
-                    return web.HTTPBadRequest('Missing argument: %s' % name)
-        logging.info('call with args: %s' % str(kw))
+                    return None, web.HTTPBadRequest(text='Unsupported Content-Type: %s' % request.content_type)
+            elif request.method == 'GET' and request.query_string:
+                kw = pick(request.query) # aiohttp已经解析并缓存了query，不需要再parse_qs整个query string
+            if kw is None:
+                kw = dict(request.match_info)
+            else:
+                for k, v in request.match_info.items(): # check named arg
+                    if k in kw:
+                        _logger.warning('Duplicate arg name in named arg and kw args: %s', k)
+                    kw[k] = v
+            return finish(request, kw)
+        return bind
+
+    def as_handler(self):
+        '''
+        Return native coroutine function for aiohttp router, carrying the options read by middlewares.
+        '''
+        # aiohttp只把协程函数当作handler直接调用，其他可调用对象会被包装一层并要求返回StreamResponse
+        async def handler(request):
+            return await self(request)
+        handler.__name__ = self._func.__name__
+        handler.__singleflight__ = self.__singleflight__
+        handler.__cache__ = self.__cache__
+        return handler
+
+    async def __call__(self, request): # 这个request是什么？哪里传入的？猜测，应该是aiohttp这个server去调用已经注册好了的handler的时候，会把request传进去
+        kw, error = await self._bind(request) # 参数的解析、过滤和检查见_compile_binder
+        if error is not None:
+            return error
+        _logger.info('call with args: %s', kw) # 惰性格式化，coroweb级别高于INFO时不会调用str(kw)
+        with timing.span('handler'):
+            try:
+                if self._validator is not None and request.method == 'GET':
+                    stamp = await self._validator(**{k: kw[k] for k in self._validator_args if k in kw})
+                    request.__stamp__ = stamp # response_middleware用它设置Last-Modified并记住ETag
+                    if stamp is not None:
+                        etag = _etags.get(_etag_key(request, stamp))
+                        if not_modified(request, etag, stamp): # 客户端缓存仍然有效，不需要执行handler
+                            return not_modified_response(etag, stamp)
+                r = await self._func(**kw)
+                return r
+            except APIError as e:
+                return dict(error=e.error, data=e.data, message=e.message)
+
+'''
+条件GET
+
+response_middleware对GET请求的200响应调用etag_response()：用body的md5作为强ETag，
+若请求的If-None-Match与之匹配则返回304。使用了@conditional的handler还会设置Last-Modified，
+并按(path_qs, 用户, 修改时间)记住ETag，下次请求在执行handler之前就可以直接返回304。
+'''
+_etags = collections.OrderedDict() # (path_qs, user id, stamp) => etag
+_ETAGS_SIZE = 10000
+
+def _etag_key(request, stamp):
+    user = getattr(request, '__user__', None)
+    return (request.path_qs, user.id if user else None, stamp)
+
+def not_modified(request, etag=None, last_modified=None):
+    ' check If-None-Match (preferred) or If-Modified-Since of request. '
+    inm = request.headers.get('If-None-Match')
+    if inm is not None:
+        if etag is None:
+            return False
+        tags = [t.strip() for t in inm.split(',')]
+        return '*' in tags or etag in tags or ('W/' + etag) in tags
+    ims = request.if_modified_since
+    if ims is not None and last_modified is not None:
+        return int(last_modified) <= ims.timestamp() # Last-Modified只精确到秒
+    return False
+
+def not_modified_response(etag=None, last_modified=None):
+    r = web.HTTPNotModified()
+    if etag is not None:
+        r.headers['ETag'] = etag
+    if last_modified is not None:
+        r.last_modified = last_modified
+    return r
+
+def etag_response(request, resp):
+    ' set ETag and Last-Modified on 200 response of GET request, and turn it into 304 if possible. '
+    if request.method != 'GET' or resp.status != 200 or not isinstance(resp.body, bytes):
+        return resp
+    etag = '"%s"' % hashlib.md5(resp.body).hexdigest()
+    resp.headers['ETag'] = etag
+    stamp = getattr(request, '__stamp__', None)
+    if stamp is not None:
+        resp.last_modified = stamp
+        resp.headers['Vary'] = 'Cookie' # 页面内容与登录用户有关
+        key = _etag_key(request, stamp)
+        _etags[key] = etag
+        _etags.move_to_end(key)
+        if len(_etags) > _ETAGS_SIZE:
+            _etags.popitem(last=False)
+    if not_modified(request, etag, stamp):
+        return not_modified_response(etag, stamp)
+    return resp
+
+'''
+singleflight_middleware是一个middleware，需要放在auth_middleware之后（需要request.__user__）、response_middleware之前（共享的是最终的Response）：
+
+app = web.Application(middlewares=[
+    logger_middleware, auth_middleware, singleflight_middleware, response_middleware
+])
+
+只有handler使用了@singleflight()、请求是GET且用户未登录时才会合并，key是path加上排序后的query参数。
+'''
+_inflight = dict() # key => Future，正在执行中的请求
+
+def _shareable(r): # 304等与请求头相关的响应不能共享
+    return isinstance(r, web.Response) and r.status == 200 and isinstance(r.body, bytes)
+
+def _copy_response(r):
+    return web.Response(body=r.body, status=r.status, headers=r.headers)
+
+@web.middleware
+async def singleflight_middleware(request, handler):
+    timeout = getattr(request.match_info.handler, '__singleflight__', None)
+    if timeout is None or request.method != 'GET' or getattr(request, '__user__', None) is not None:
+        return await handler(request)
+    key = (request.path, tuple(sorted(request.query.items())))
+    fut = _inflight.get(key)
+    if fut is not None: # 已经有相同的请求在执行，等待它的结果
         try:
-            r = yield from self._func(**kw)
-            return r
-        except APIError as e:
-            return dict(error=e.error, data=e.data, message=e.message)
+            r = await asyncio.wait_for(asyncio.shield(fut), timeout)
+        except asyncio.TimeoutError:
+            r = None
+        if r is not None:
+            return _copy_response(r)
+        return await handler(request) # 超时或结果不可共享，自己执行
+    fut = asyncio.Future()
+    _inflight[key] = fut
+    try:
+        r = await handler(request)
+    except BaseException as e:
+        fut.set_result(None)
+        raise
+    finally:
+        _inflight.pop(key, None)
+    fut.set_result(r if _shareable(r) else None)
+    return r
 
 # 接下来实现一些 add_ 函数
 def add_static(app):
@@ -209,10 +428,9 @@ def add_route(app, fn):
     path = getattr(fn, '__route__', None)
     if path is None or method is None:
         raise ValueError('@get or @post not defined in %s.' % str(fn))
-    if not asyncio.iscoroutinefunction(fn) and not inspect.isgeneratorfunction(fn):
-        fn = asyncio.coroutine(fn)
+    fn = to_coroutine(fn) # 普通函数也可以作为handler，async def定义的handler直接使用
     logging.info('add route %s %s => %s(%s)' % (method, path, fn.__name__, ', '.join(inspect.signature(fn).parameters.keys())))
-    app.router.add_route(method, path, RequestHandler(app, fn))
+    app.router.add_route(method, path, RequestHandler(app, fn).as_handler())
 
 # 最后一步，把很多次add_route()注册的调用变成自动扫描：自动把handler模块的所有符合条件的函数注册了
 def add_routes(app, module_name):
@@ -234,8 +452,8 @@ def add_routes(app, module_name):
 
 # 最后，在app.py中加入middleware、jinja2模板和自注册的支持
 '''
-app = web.Application(loop=loop, middlewares=[
-    logger_factory, response_factory
+app = web.Application(middlewares=[
+    logger_middleware, response_middleware
 ])
 init_jinja2(app, filters=dict(datetime=datetime_filter))
 add_routes(app, 'handlers')
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jassion Zhao'
+
+'''
+database drivers used by orm.
+
+orm只负责拼装SQL语句（占位符统一用?），真正访问数据库的工作交给这里的driver：
+
+MySQLDriver  : 基于aiomysql的连接池，生产环境使用
+SQLiteDriver : 基于标准库sqlite3，用一个单独的线程执行所有SQL，不依赖任何外部服务，用于压测、benchmark和测试
+'''
+
+import abc, asyncio, logging, sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+class Driver(abc.ABC):
+    '''
+    Base class of database drivers. Sub classes must implement all the abstract coroutines below.
+    '''
+    name = None
+
+    @abc.abstractmethod
+    async def create_pool(self, loop, **kw):
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def close(self):
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def select(self, sql, args, size=None):
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def execute(self, sql, args, autocommit=True):
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def explain(self, sql, args):
+        ' return the query plan of sql, must not use the connections of the pool. '
+        raise NotImplementedError()
+
+    async def execute_script(self, sqls):
+        ' execute ddl statements one by one, used to create schema. '
+        for sql in sqls:
+            await self.execute(sql, ())
+
+    def stats(self):
+        ' connections of the pool: dict(size=, free=, max=), used by /metrics. '
+        return dict()
+
+class MySQLDriver(Driver):
+    name = 'mysql'
+
+    def __init__(self):
+        self._pool = None
+        self._side_conn = None
+        self._side_lock = None
+
+    async def create_pool(self, loop, **kw):
+        import aiomysql # 只有使用mysql时才需要安装aiomysql
+        self._aiomysql = aiomysql
+        self._conn_kw = dict(
+            host=kw.get('host', 'localhost'),
+            port=kw.get('port', 3306),
+            user=kw['user'],
+            password=kw['password'],
+            db=kw['database'],
+            charset=kw.get('charset', 'utf8'),
+            autocommit=kw.get('autocommit', True),
+            loop=loop
+        )
+        self._pool = await aiomysql.create_pool(
+            maxsize=kw.get('maxsize', 10),
+            minsize=kw.get('minsize', 1),
+            **self._conn_kw
+        )
+
+    async def close(self):
+        if self._side_conn is not None:
+            self._side_conn.close()
+            self._side_conn = None
+        if self._pool is not None:
+            self._pool.close()
+            await self._pool.wait_closed()
+            self._pool = None
+
+    async def select(self, sql, args, size=None):
+        async with self._pool.acquire() as conn:
+            cur = await conn.cursor(self._aiomysql.DictCursor)
+            await cur.execute(sql.replace('?', '%s'), args or ()) # MySQL的占位符是%s
+            if size:
+                rs = await cur.fetchmany(size)
+            else:
+                rs = await cur.fetchall()
+            await cur.close()
+            return rs
+
+    async def execute(self, sql, args, autocommit=True):
+        async with self._pool.acquire() as conn:
+            if not autocommit:
+                await conn.begin()
+            try:
+                cur = await conn.cursor()
+                await cur.execute(sql.replace('?', '%s'), args)
+                affected = cur.rowcount
+                await cur.close()
+                if not autocommit:
+                    await conn.commit()
+            except BaseException as e:
+                if not autocommit:
+                    await conn.rollback()
+                raise
+            return affected
+
+    async def explain(self, sql, args):
+        # 旁路连接：不占用连接池，慢查询较多时也不会影响正常请求
+        if self._side_lock is None:
+            self._side_lock = asyncio.Lock()
+        async with self._side_lock:
+            if self._side_conn is None:
+                self._side_conn = await self._aiomysql.connect(**self._conn_kw)
+            cur = await self._side_conn.cursor(self._aiomysql.DictCursor)
+            await cur.execute('explain ' + sql.replace('?', '%s'), args or ())
+            rs = await cur.fetchall()
+            await cur.close()
+            return list(rs)
+
+    def stats(self):
+        if self._pool is None:
+            return dict()
+        return dict(size=self._pool.size, free=self._pool.freesize, max=self._pool.maxsize)
+
+class SQLiteDriver(Driver):
+    '''
+    sqlite3 driver. All statements run on one worker thread which owns the connection,
+    so every call (including begin/commit of a transaction) is serialized.
+    '''
+    name = 'sqlite'
+
+    def __init__(self):
+        self._conn = None
+        self._executor = None
+        self._loop = None
+
+    async def create_pool(self, loop, **kw):
+        self._loop = loop or asyncio.get_event_loop()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        database = kw.get('database', ':memory:')
+        await self._run(self._connect, database)
+        logging.info('sqlite database: %s' % database)
+
+    def _connect(self, database):
+        # isolation_level=None 即autocommit，需要事务时由_execute显式begin
+        self._conn = sqlite3.connect(database, isolation_level=None, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+
+    def _run(self, fn, *args):
+        return self._loop.run_in_executor(self._executor, fn, *args)
+
+    async def close(self):
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _select(self, sql, args, size):
+        cur = self._conn.execute(sql, args or ())
+        try:
+            rs = cur.fetchmany(size) if size else cur.fetchall()
+        finally:
+            cur.close()
+        return [dict(r) for r in rs]
+
+    def _execute(self, sql, args, autocommit):
+        if not autocommit:
+            self._conn.execute('begin')
+        try:
+            cur = self._conn.execute(sql, args or ())
+            affected = cur.rowcount
+            cur.close()
+            if not autocommit:
+                self._conn.execute('commit')
+        except BaseException as e:
+            if not autocommit:
+                self._conn.execute('rollback')
+            raise
+        return affected
+
+    def _execute_script(self, sqls):
+        for sql in sqls:
+            self._conn.execute(sql)
+
+    async def select(self, sql, args, size=None):
+        return await self._run(self._select, sql, args, size)
+
+    async def execute(self, sql, args, autocommit=True):
+        return await self._run(self._execute, sql, args, autocommit)
+
+    async def explain(self, sql, args):
+        return await self._run(self._select, 'explain query plan ' + sql, args, None)
+
+    async def execute_script(self, sqls):
+        await self._run(self._execute_script, list(sqls))
+
+    def stats(self):
+        if self._conn is None:
+            return dict()
+        return dict(size=1, max=1) # 只有一个连接，所有SQL在线程中排队执行
+
+_DRIVERS = {
+    MySQLDriver.name: MySQLDriver,
+    SQLiteDriver.name: SQLiteDriver
+}
+
+def get_driver(name):
+    '''
+    Create driver instance by name: 'mysql' or 'sqlite'.
+    '''
+    cls = _DRIVERS.get(name)
+    if cls is None:
+        raise ValueError('Unsupported database driver: %s' % name)
+    return cls()
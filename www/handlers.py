@@ -7,19 +7,26 @@ __author__ = 'Jassion Zhao'
 url handlers
 '''
 
-import re, time, json, logging, hashlib, base64, asyncio
-from coroweb import get, post
+import re, os, sys, time, json, logging, hashlib, base64
+from coroweb import get, post, singleflight, conditional
+from querylog import slow_queries, query_stats
+from cache import cached, invalidate
+import orm, profiler
 from models import User, Blog, Comment, next_id
 
 from aiohttp import web
-from apis import APIValueError, APIResourceNotFoundError, APIPermissionError, Page
+from apis import APIError, APIValueError, APIResourceNotFoundError, APIPermissionError, Page
 from config import configs
 
-import markdown2
+from mdrender import markdown, safe_markdown, IncrementalRenderer
 
 COOKIE_NAME = 'jassionsession'
+_STREAM_CONTENT_SIZE = 256 * 1024 # 日志正文超过该长度时流式渲染
+_COMMENTS_PAGE_SIZE = 20 # 日志页面内嵌最新的评论数，更早的评论通过/api/blogs/{id}/comments分页加载
 _COOKIE_KEY = configs.session.secret
 
+_preview = IncrementalRenderer(extras=configs.markdown.extras) # 编辑日志时的实时预览，按块缓存渲染结果
+
 def check_admin(request):
     if request.__user__ is None or not request.__user__.admin:
         raise APIPermissionError()
@@ -34,10 +41,31 @@ def get_page_index(page_str):
         p = 1
     return p
 
+# 嵌入到<script>中的JSON需要转义<、>、&以及JS中不能出现在字符串里的U+2028/U+2029
+_JSON_SCRIPT_ESCAPES = {'<': '\\u003c', '>': '\\u003e', '&': '\\u0026', '\u2028': '\\u2028', '\u2029': '\\u2029'}
+_RE_JSON_SCRIPT = re.compile('[<>&\u2028\u2029]')
+
+def json2script(obj):
+    '''
+    Serialize obj to JSON which can be embedded in <script> safely, used by server side rendering.
+    '''
+    s = json.dumps(obj, ensure_ascii=False, default=lambda o: o.__dict__)
+    return _RE_JSON_SCRIPT.sub(lambda m: _JSON_SCRIPT_ESCAPES[m.group(0)], s)
+
 def text2html(text):
     lines = map(lambda s: '<p>%s</p>' % s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;'), filter(lambda s: s.strip() != '', text.split('\n')))
     return ''.join(lines)
 
+def comment2html(text):
+    '''
+    Render comment once at write time: sanitized markdown, or text2html if markdown fails.
+    '''
+    try:
+        return safe_markdown(text)
+    except Exception as e:
+        logging.exception(e)
+        return text2html(text)
+
 def user2cookie(user, max_age): # 使用传进来的user，制作cookie string
     '''
     Generate cookie str by user.
@@ -48,8 +76,7 @@ def user2cookie(user, max_age): # 使用传进来的user，制作cookie string
     L = [user.id, expires, hashlib.sha1(s.encode('utf-8')).hexdigest()] # L是一个list
     return '-'.join(L) # 用 - 分割，为了便于解析
 
-@asyncio.coroutine
-def cookie2user(cookie_str): # 解析传入的cookie string，若是该cookie有效，则返回该user
+async def cookie2user(cookie_str): # 解析传入的cookie string，若是该cookie有效，则返回该user
     '''
     Parse cookie and load user if cookie is valid.
     '''
@@ -62,7 +89,7 @@ def cookie2user(cookie_str): # 解析传入的cookie string，若是该cookie有
         uid, expires, sha1 = L
         if int(expires) < time.time():
             return None
-        user = yield from User.find(uid) # cookie有效，则去users表中查找对应id的user
+        user = await User.find(uid) # cookie有效，则去users表中查找对应id的user
         if user is None:
             return None
         s = '%s-%s-%s-%s' % (uid, user.passwd, expires, _COOKIE_KEY)
@@ -75,13 +102,84 @@ def cookie2user(cookie_str): # 解析传入的cookie string，若是该cookie有
         logging.exception(e)
         return None
 
+async def blog_stamp(id): # 只查询updated_at，比加载整篇日志和全部评论便宜得多
+    return await Blog.findNumber('updated_at', '`id`=?', [id])
+
+async def touch_blog(blog_id, comments): # 评论增删时维护评论数、更新日志的updated_at，并让页面缓存失效
+    await Blog.add_comments(blog_id, comments)
+    invalidate('blog:%s' % blog_id)
+
+def comment_cursor(comment):
+    return '%r:%s' % (comment.created_at, comment.id)
+
+async def blog_comments(blog_id, before=None, size=_COMMENTS_PAGE_SIZE):
+    '''
+    Load comments of blog newest first, before the cursor (created_at:id) if given.
+    Return (comments, next_cursor), next_cursor is None if there is no older comment.
+    '''
+    if before:
+        try:
+            t, cid = before.split(':', 1)
+            t = float(t)
+        except ValueError:
+            raise APIValueError('before', 'invalid cursor.')
+        # (created_at, id) 组成的游标，created_at相同时用id区分，走(blog_id, created_at)索引
+        comments = await Comment.findAll('`blog_id`=? and (`created_at`<? or (`created_at`=? and `id`<?))', [blog_id, t, t, cid], orderBy='`created_at` desc, `id` desc', limit=size + 1)
+    else:
+        comments = await Comment.findAll('`blog_id`=?', [blog_id], orderBy='`created_at` desc, `id` desc', limit=size + 1)
+    next_cursor = None
+    if len(comments) > size:
+        comments = comments[:size]
+        next_cursor = comment_cursor(comments[-1])
+    for c in comments:
+        if not c.html_content: # 还没有回填html_content的旧评论
+            c.html_content = text2html(c.content)
+    return comments, next_cursor
+
+# 分页查询：API和服务端渲染(SSR)的页面共用
+async def blogs_page(page_index):
+    num = await Blog.findNumber('count(id)') # Mysql函数： count(列名)---只包括列名指定列，返回指定列的记录数,这里返回的就是id这一列的行数，也就是blog的数量
+    p = Page(num, page_index)
+    if num == 0:
+        return dict(page=p, blogs=())
+    blogs = await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    return dict(page=p, blogs=blogs)
+
+async def users_page(page_index):
+    num = await User.findNumber('count(id)')
+    p = Page(num, page_index)
+    if num == 0:
+        return dict(page=p, users=())
+    users = await User.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    for u in users:
+        u.passwd = '******'
+    return dict(page=p, users=users)
+
+async def comments_page(page_index):
+    num = await Comment.findNumber('count(id)')
+    p = Page(num, page_index)
+    if num == 0:
+        return dict(page=p, comments=())
+    comments = await Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    return dict(page=p, comments=comments)
+
+async def initial_data(load, page_index):
+    ' SSR: query the first page on server and embed it into template, or None if ssr is off. '
+    if not configs.ssr:
+        return None
+    data = await load(page_index)
+    return json2script(data)
+
 ## Path route
 
 @get('/')
-def index(*, page='1'): 
+@cached(ttl=60, stale=600, tags=('blogs',))
+async def index(*, page='1'): 
+    page_index = get_page_index(page)
     return {
         '__template__': 'blogs.html',
-        'page_index': get_page_index(page)
+        'page_index': page_index,
+        'initial_data': (await initial_data(blogs_page, page_index))
     }
 
 @get('/signin')
@@ -105,16 +203,19 @@ def register():
     }
 
 @get('/blog/{id}')
-def get_blog(id):
-    blog = yield from Blog.find(id)
-    comments = yield from Comment.findAll('blog_id=?', [id], orderBy='created_at desc') # desc 指定降序排列
-    for c in comments:
-        c.html_content = text2html(c.content)
-    blog.html_content = markdown2.markdown(blog.content)
+@cached(ttl=60, stale=600, tags=('blog:{id}',))
+@singleflight()
+@conditional(blog_stamp)
+async def get_blog(id):
+    blog = await Blog.find(id)
+    comments, next_cursor = await blog_comments(id) # 只内嵌最新的一页评论
+    blog.html_content = markdown(blog.content, extras=configs.markdown.extras)
     return {
         '__template__': 'blog.html',
+        '__stream__': len(blog.content) > _STREAM_CONTENT_SIZE, # 很长的日志流式渲染，否则渲染成完整的body以便缓存和计算ETag
         'blog': blog,
-        'comments': comments
+        'comments': comments,
+        'next_cursor': next_cursor
     }
 
 @get('/manage/')
@@ -130,10 +231,12 @@ def manage_create_blog():
     }
 
 @get('/manage/blogs')
-def manage_blogs(*, page='1'):
+async def manage_blogs(*, page='1'):
+    page_index = get_page_index(page)
     return {
         '__template__': 'manage_blogs.html',
-        'page_index': get_page_index(page)
+        'page_index': page_index,
+        'initial_data': (await initial_data(blogs_page, page_index))
     }
 
 @get('/manage/blogs/edit')
@@ -145,58 +248,106 @@ def manage_edit_blog(*, id):
     }
 
 @get('/manage/comments')
-def manage_comments(*, page='1'):
+async def manage_comments(*, page='1'):
+    page_index = get_page_index(page)
     return {
         '__template__': 'manage_comments.html',
-        'page_index': get_page_index(page)
+        'page_index': page_index,
+        'initial_data': (await initial_data(comments_page, page_index))
     }
 
 @get('/manage/users')
-def manage_users(*, page='1'):
+async def manage_users(*, page='1'):
+    page_index = get_page_index(page)
     return {
         '__template__': 'manage_users.html',
-        'page_index': get_page_index(page)
+        'page_index': page_index,
+        'initial_data': (await initial_data(users_page, page_index))
     }
 
 ## API
 
 # API @get
 @get('/api/blogs/{id}')
-def api_get_blog(*, id):
-    blog = yield from Blog.find(id)
+@cached(ttl=60, stale=600, tags=('blog:{id}',))
+@singleflight()
+@conditional(blog_stamp)
+async def api_get_blog(*, id):
+    blog = await Blog.find(id)
     return blog
 
 @get('/api/blogs')
-def api_blogs(*, page='1'):
-    page_index = get_page_index(page)
-    num = yield from Blog.findNumber('count(id)') # Mysql函数： count(列名)---只包括列名指定列，返回指定列的记录数,这里返回的就是id这一列的行数，也就是blog的数量
-    p = Page(num, page_index)
-    if num == 0:
-        return dict(page=p, blogs=())
-    blogs = yield from Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
-    return dict(page=p, blogs=blogs)
+@cached(ttl=30, stale=300, tags=('blogs',))
+@singleflight()
+async def api_blogs(*, page='1'):
+    return await blogs_page(get_page_index(page))
+
+@get('/api/blogs/{id}/comments')
+@cached(ttl=60, stale=600, tags=('blog:{id}',))
+@conditional(blog_stamp)
+async def api_blog_comments(*, id, before=None):
+    comments, next_cursor = await blog_comments(id, before)
+    return dict(comments=comments, next=next_cursor)
 
 @get('/api/users')
-def api_get_users(*, page='1'):
-    page_index = get_page_index(page)
-    num = yield from User.findNumber('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
-        return dict(page=p, users=())
-    users = yield from User.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
-    for u in users:
-        u.passwd = '******'
-    return dict(page=p, users=users)
+async def api_get_users(*, page='1'):
+    return await users_page(get_page_index(page))
 
 @get('/api/comments')
-def api_comments(*, page='1'):
-    page_index = get_page_index(page)
-    num = yield from Comment.findNumber('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
-        return dict(page=p, comments=())
-    comments = yield from Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
-    return dict(page=p, comments=comments)
+async def api_comments(*, page='1'):
+    return await comments_page(get_page_index(page))
+
+@get('/api/ready')
+async def api_ready(request):
+    # readiness检查：worker正在退出（处理完进行中的请求）时返回503，数据库不可用时返回500
+    if not request.app['__state__']['ready']:
+        return 503, 'draining'
+    await orm.select('select 1', [])
+    return dict(ready=True, pid=os.getpid())
+
+@get('/manage/api/slowqueries')
+def api_slow_queries(request):
+    check_admin(request)
+    return dict(threshold=slow_queries.threshold, queries=slow_queries.entries())
+
+@get('/manage/api/querystats')
+def api_query_stats(request):
+    check_admin(request)
+    return dict(since=query_stats.since, queries=query_stats.entries())
+
+_PROFILE_MAX_SECONDS = 30 # 不能超过nginx的proxy_read_timeout(60秒)
+
+@get('/manage/api/profile')
+async def api_profile(request, *, mode='cpu', seconds='10', interval='0.01', limit='10'):
+    # 对处理这个请求的worker采样，mode=cpu返回collapsed stacks，mode=alloc返回各路由的内存分配，见profiler.py
+    check_admin(request)
+    try:
+        seconds = float(seconds)
+    except ValueError:
+        raise APIValueError('seconds')
+    if not 0 < seconds <= _PROFILE_MAX_SECONDS:
+        raise APIValueError('seconds', 'seconds must be in (0, %s].' % _PROFILE_MAX_SECONDS)
+    if profiler.running():
+        raise APIError('profile:busy', 'profile', 'another profile is running in this worker.')
+    if mode == 'cpu':
+        try:
+            interval = float(interval)
+        except ValueError:
+            raise APIValueError('interval')
+        if not 0.001 <= interval <= 1:
+            raise APIValueError('interval', 'interval must be in [0.001, 1].')
+        text = await profiler.profile_cpu(seconds, interval)
+        filename = 'cpu-%s-%s.collapsed' % (os.getpid(), time.strftime('%Y%m%d%H%M%S'))
+        return web.Response(text=text, content_type='text/plain', charset='utf-8',
+                            headers={'Content-Disposition': 'attachment; filename="%s"' % filename})
+    if mode == 'alloc':
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise APIValueError('limit')
+        routes = await profiler.profile_alloc(seconds, sys.modules[__name__], limit)
+        return dict(pid=os.getpid(), seconds=seconds, routes=routes)
+    raise APIValueError('mode', 'mode must be cpu or alloc.')
 
 
 # API @post
@@ -205,7 +356,7 @@ _RE_EMAIL = re.compile(r'^[a-z0-9\.\-\_]+\@[a-z0-9\-\_]+(\.[a-z0-9\-\_]+){1,4}$'
 _RE_SHA1 = re.compile(r'^[0-9a-f]{40}$')
 
 @post('/api/users') # 点击注册会进入该path，通过js的处理进来：register.html中的$form.postJSON('/api/users'，其中postJSON在\static\js\awesome.js
-def api_register_users(*, email, name, passwd):
+async def api_register_users(*, email, name, passwd):
     logging.info('in api_register_users')
     if not name or not name.strip():
         raise APIValueError('name')
@@ -213,14 +364,14 @@ def api_register_users(*, email, name, passwd):
         raise APIValueError('email')
     if not passwd or not _RE_SHA1.match(passwd):
         raise APIValueError('passwd')
-    users = yield from User.findAll('email=?', [email]) #检查该email是否已经注册过
+    users = await User.findAll('email=?', [email]) #检查该email是否已经注册过
 #    logging.info('find users who have the email')
     if len(users) > 0:
         raise APIError('register:failed', 'email', 'Email is already in use.')
     uid = next_id() # 该email没注册过，则生成id，加密密码并完成注册，存到mysql的users表中
     sha1_passwd = '%s:%s' % (uid, passwd)
     user = User(id=uid, name=name.strip(), email=email, passwd=hashlib.sha1(sha1_passwd.encode('utf-8')).hexdigest(), image='http://www.gravatar.com/avatar/%s?d=mm&s=120' % hashlib.md5(email.encode('utf-8')).hexdigest())
-    yield from user.save()
+    await user.save()
 
     # make session cookie:为该user生成cookie
     r = web.Response()
@@ -231,12 +382,12 @@ def api_register_users(*, email, name, passwd):
     return r
 
 @post('/api/authenticate') # 点击登录会进入该path，执行该handler
-def authenticate(*, email, passwd):
+async def authenticate(*, email, passwd):
     if not email:
         raise APIValueError('email', 'Invalid email.')
     if not passwd:
         raise APIValueError('passwd', 'Invalid password.')
-    users = yield from User.findAll('email=?', [email])
+    users = await User.findAll('email=?', [email])
     if len(users) == 0:
         raise APIValueError('email', 'Email not exist.')
     user = users[0] # 取找到的第一个user对象
@@ -256,7 +407,7 @@ def authenticate(*, email, passwd):
     return r
 
 @post('/api/blogs')
-def api_create_blog(request, *, name, summary, content):
+async def api_create_blog(request, *, name, summary, content):
     check_admin(request)
     if not name or not name.strip():
         raise APIValueError('name', 'name cannot be empty.')
@@ -265,13 +416,19 @@ def api_create_blog(request, *, name, summary, content):
     if not content or not content.strip():
         raise APIValueError('content', 'content cannot be empty.')
     blog = Blog(user_id=request.__user__.id, user_name=request.__user__.name, user_image=request.__user__.image, name=name.strip(), summary=summary.strip(), content=content.strip())
-    yield from blog.save()
+    await blog.save()
+    invalidate('blogs')
     return blog
 
+@post('/manage/api/blogs/preview')
+def api_preview_blog(request, *, content):
+    check_admin(request)
+    return dict(html=_preview.render(content))
+
 @post('/api/blogs/{id}')
-def api_update_blog(id, request, *, name, summary, content):
+async def api_update_blog(id, request, *, name, summary, content):
     check_admin(request)
-    blog = yield from Blog.find(id)
+    blog = await Blog.find(id)
     if not name or not name.strip():
         raise APIValueError('name', 'name cannot be empty.')
     if not summary or not summary.strip():
@@ -281,36 +438,48 @@ def api_update_blog(id, request, *, name, summary, content):
     blog.name = name.strip()
     blog.summary = summary.strip()
     blog.content = content.strip()
-    yield from blog.update()
+    blog.updated_at = time.time()
+    await blog.update()
+    invalidate('blogs', 'blog:%s' % id)
     return blog
 
 @post('/api/blogs/{id}/delete')
-def api_delete_blog(request, *, id):
+async def api_delete_blog(request, *, id):
     check_admin(request)
-    blog = yield from Blog.find(id)
-    yield from blog.remove()
+    blog = await Blog.find(id)
+    await blog.remove()
+    invalidate('blogs', 'blog:%s' % id)
     return dict(id=id)
 
 @post('/api/blogs/{id}/comments')
-def api_create_comment(id, request, *, content):
+async def api_create_comment(id, request, *, content):
     user = request.__user__
     if user is None:
         raise APIPermissionError('Please signin first.')
     if not content or not content.strip():
         raise APIValueError('content', 'content cannot be empty')
-    blog = yield from Blog.find(id)
+    blog = await Blog.find(id)
     if blog is None:
         raise APIResourceNotFoundError('Blog')
-    comment = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name, user_image=user.image, content=content.strip())
-    yield from comment.save()
+    content = content.strip()
+    comment = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name, user_image=user.image, content=content, html_content=comment2html(content))
+    await comment.save()
+    await touch_blog(blog.id, 1)
     return comment
 
+@post('/manage/api/querystats/reset')
+def api_reset_query_stats(request):
+    check_admin(request)
+    query_stats.reset()
+    return dict(since=query_stats.since)
+
 @post('/api/comments/{id}/delete')
-def api_delete_comments(id, request):
+async def api_delete_comments(id, request):
     check_admin(request)
-    c = yield from Comment.find(id)
+    c = await Comment.find(id)
     if c is None:
         raise APIResourceNotFoundError('Comment')
-    yield from c.remove()
+    await c.remove()
+    await touch_blog(c.blog_id, -1)
     return dict(id=id)
 
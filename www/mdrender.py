@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jassion Zhao'
+
+'''
+markdown rendering with reusable converters.
+
+markdown2.markdown()每次调用都会新建一个Markdown对象（拷贝extras、escape table等），
+这里为每种配置(safe_mode + extras)保存一组配置好的Markdown对象，转换时从池中取出一个，用完放回。
+Markdown.convert()会修改对象内部的状态，所以同一时刻一个对象只能被一个调用使用；
+池用list实现，pop()/append()在CPython中是原子操作，在线程池(run_in_executor)中调用也是安全的。
+
+与tab宽度相关的正则在markdown2模块import时就已经编译好(见markdown2._precompile)。
+
+    html = markdown(blog.content)
+    html = safe_markdown(comment.content)   # 不可信的内容：转义原始HTML，并过滤渲染结果
+
+编辑器的实时预览使用IncrementalRenderer：把文档按空行切分成顶层的块，每个块渲染后按内容的hash缓存，
+修改长文章时只有改动过的块需要重新转换；代码块的pygments高亮结果也单独缓存。
+'''
+
+import collections, hashlib, html, re
+from html.parser import HTMLParser
+
+import markdown2
+import timing
+
+_POOL_SIZE = 4
+
+class LRUCache(object):
+    '''
+    Simple LRU cache of rendered html.
+    '''
+    def __init__(self, size):
+        self.size = size
+        self._data = collections.OrderedDict()
+
+    def get(self, key):
+        value = self._data.get(key)
+        if value is not None:
+            self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.size:
+            self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+_highlighted = LRUCache(500) # 代码块内容+语言 => 高亮后的html
+
+def _digest(text):
+    return hashlib.sha1(text.encode('utf-8')).digest()
+
+class HighlightingMarkdown(markdown2.Markdown):
+    '''
+    Markdown which caches the pygments output of fenced code blocks.
+    '''
+    def _color_with_pygments(self, codeblock, lexer, **formatter_opts):
+        key = (_digest(codeblock), lexer.name, repr(sorted(formatter_opts.items())))
+        html = _highlighted.get(key)
+        if html is None:
+            html = super(HighlightingMarkdown, self)._color_with_pygments(codeblock, lexer, **formatter_opts)
+            _highlighted.set(key, html)
+        return html
+
+class MarkdownPool(object):
+    '''
+    Pool of pre-configured markdown2.Markdown instances with the same options.
+    '''
+    def __init__(self, size=_POOL_SIZE, **options):
+        self.size = size
+        self.options = options
+        self._idle = [self._create() for i in range(size)]
+
+    def _create(self):
+        return HighlightingMarkdown(**self.options)
+
+    def convert(self, text):
+        try:
+            md = self._idle.pop()
+        except IndexError: # 所有对象都在使用中（多线程时），临时新建一个
+            md = self._create()
+        try:
+            with timing.span('md'):
+                return md.convert(text)
+        finally:
+            md.reset() # 释放上一篇文档的urls、html_blocks等
+            if len(self._idle) < self.size:
+                self._idle.append(md)
+
+_pools = dict()
+
+def get_pool(safe_mode=None, extras=None):
+    ' return the converter pool of the options, created on first use. '
+    extras = tuple(sorted(extras or ()))
+    key = (safe_mode, extras)
+    pool = _pools.get(key)
+    if pool is None:
+        pool = _pools.setdefault(key, MarkdownPool(safe_mode=safe_mode, extras=list(extras)))
+    return pool
+
+def markdown(text, safe_mode=None, extras=None):
+    '''
+    Convert markdown text to html, same as markdown2.markdown() but reuses converters.
+    '''
+    return get_pool(safe_mode, extras).convert(text)
+
+# 评论等不可信内容渲染后的白名单过滤：markdown2在safe_mode下会转义原始HTML，
+# 但链接的URL和title只是简单拼接到属性中，可以用引号跳出属性，所以渲染结果要重新解析、
+# 只保留白名单中的标签和属性，属性值重新转义后输出
+_ALLOWED_TAGS = {
+    'a': ('href', 'title'),
+    'img': ('src', 'alt', 'title'),
+    'p': (), 'br': (), 'hr': (), 'em': (), 'strong': (), 'b': (), 'i': (), 'del': (),
+    'code': (), 'pre': (), 'blockquote': (), 'ul': (), 'ol': (), 'li': (), 'sup': (), 'sub': (),
+    'h1': (), 'h2': (), 'h3': (), 'h4': (), 'h5': (), 'h6': (),
+    'table': (), 'thead': (), 'tbody': (), 'tr': (), 'th': ('align',), 'td': ('align',)
+}
+_VOID_TAGS = ('br', 'hr', 'img')
+_DROP_CONTENT_TAGS = ('script', 'style') # 不在白名单中的其他标签只去掉标签，保留文本
+_URL_ATTRS = ('href', 'src')
+_SAFE_URL_SCHEMES = ('http', 'https', 'ftp', 'mailto')
+_RE_URL_IGNORED = re.compile(r'[\x00-\x20]+')
+
+def safe_url(url):
+    ' return url if its scheme is allowed (or relative), else None. '
+    u = _RE_URL_IGNORED.sub('', url) # 浏览器会忽略URL中的空白和控制字符
+    head = u.split('/', 1)[0]
+    if ':' in head and head.split(':', 1)[0].lower() not in _SAFE_URL_SCHEMES:
+        return None
+    return url
+
+class _Sanitizer(HTMLParser):
+    def __init__(self):
+        super(_Sanitizer, self).__init__(convert_charrefs=True)
+        self.out = []
+        self._dropping = 0
+
+    def _starttag(self, tag, attrs, close):
+        if tag in _DROP_CONTENT_TAGS:
+            self._dropping += 0 if close else 1
+            return
+        allowed = _ALLOWED_TAGS.get(tag)
+        if allowed is None or self._dropping:
+            return
+        L = ['<', tag]
+        for name, value in attrs:
+            if name not in allowed or value is None:
+                continue
+            if name in _URL_ATTRS:
+                value = safe_url(value)
+                if value is None:
+                    value = '#'
+            L.append(' %s="%s"' % (name, html.escape(value, quote=True)))
+        L.append(' />' if tag in _VOID_TAGS else '>')
+        self.out.append(''.join(L))
+
+    def handle_starttag(self, tag, attrs):
+        self._starttag(tag, attrs, False)
+
+    def handle_startendtag(self, tag, attrs):
+        self._starttag(tag, attrs, True)
+
+    def handle_endtag(self, tag):
+        if tag in _DROP_CONTENT_TAGS:
+            self._dropping = max(0, self._dropping - 1)
+        elif tag in _ALLOWED_TAGS and tag not in _VOID_TAGS and not self._dropping:
+            self.out.append('</%s>' % tag)
+
+    def handle_data(self, data):
+        if not self._dropping:
+            self.out.append(html.escape(data, quote=False))
+
+def sanitize_html(s):
+    '''
+    Re-serialize html keeping only allowed tags and attributes, attribute values are escaped again.
+    '''
+    parser = _Sanitizer()
+    parser.feed(s)
+    parser.close()
+    return ''.join(parser.out)
+
+def safe_markdown(text):
+    '''
+    Convert untrusted markdown (comments) to html: raw html escaped, output sanitized.
+    '''
+    return sanitize_html(markdown(text, safe_mode='escape'))
+
+_RE_LIST_ITEM = re.compile(r'^[ ]{0,3}(?:[*+-]|\d+\.)[ \t]+')
+_RE_DEFINITION = re.compile(r'^[ ]{0,3}\[\^?[^\]]+\]:', re.M)
+_RE_HTML_BLOCK = re.compile(r'^<(%s)\b' % markdown2.Markdown._block_tags_b) # 与markdown2识别原始HTML块的规则一致
+
+def _html_block_end(tag):
+    ' return regex matching the line which closes the raw html block. '
+    return re.compile(r'</%s>[ \t]*$' % tag)
+
+def _closes(lines, end):
+    return any(end.search(line) for line in lines)
+
+def split_blocks(text):
+    '''
+    Split markdown text into top level blocks separated by blank lines.
+    Fenced code blocks, indented continuations, list items, blockquotes and raw html blocks stay with their block.
+    '''
+    blocks = []
+    lines = []
+    fenced = False
+    for line in text.replace('\r\n', '\n').replace('\r', '\n').split('\n'):
+        if line.startswith('```'):
+            fenced = not fenced
+        if not fenced and not line.strip():
+            if lines:
+                blocks.append(lines)
+                lines = []
+            continue
+        lines.append(line)
+    if lines:
+        blocks.append(lines)
+    merged = []
+    end = None # 未闭合的原始HTML块的结束标签
+    for lines in blocks:
+        first = lines[0]
+        # 缩进的行属于上一个块（列表项的后续段落、代码块），相邻的列表项属于同一个列表，
+        # 相邻的引用属于同一个blockquote，原始HTML块一直合并到结束标签所在的块
+        if merged and (end is not None or first[:1] in (' ', '\t')
+                       or (_RE_LIST_ITEM.match(first) and _RE_LIST_ITEM.match(merged[-1][0]))
+                       or (first.startswith('>') and merged[-1][0].startswith('>'))):
+            merged[-1].append('')
+            merged[-1].extend(lines)
+            if end is not None and _closes(lines, end):
+                end = None
+            continue
+        merged.append(lines)
+        m = _RE_HTML_BLOCK.match(first)
+        if m:
+            end = _html_block_end(m.group(1))
+            if _closes(lines, end):
+                end = None
+    return ['\n'.join(lines) for lines in merged]
+
+class IncrementalRenderer(object):
+    '''
+    Render markdown block by block, caching the html of each block by its content hash.
+    '''
+    def __init__(self, size=2000, safe_mode=None, extras=None):
+        self.pool = get_pool(safe_mode, extras)
+        self._blocks = LRUCache(size)
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, text):
+        if _RE_DEFINITION.search(text): # 引用式链接、脚注的定义对整篇文档有效，不能分块渲染
+            self.misses += 1
+            return self.pool.convert(text)
+        L = []
+        for block in split_blocks(text):
+            key = _digest(block)
+            html = self._blocks.get(key)
+            if html is None:
+                self.misses += 1
+                html = self.pool.convert(block)
+                self._blocks.set(key, html)
+            else:
+                self.hits += 1
+            L.append(html)
+        return '\n'.join(L)
+
+# 日志正文和评论使用的两种配置，import时就创建好
+get_pool()
+get_pool(safe_mode='escape')
@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jassion Zhao'
+
+'''
+metrics in prometheus text format.
+
+metrics_middleware按路由模板（如/blog/{id}，而不是实际的path）统计请求数、状态码、延迟分布和正在处理的请求数；
+页面缓存命中、数据库连接池等状态在导出时通过回调函数读取。GET /metrics 返回Prometheus的文本格式：
+
+    scrape_configs:
+      - job_name: jsnwebapp
+        static_configs:
+          - targets: ['127.0.0.1:80']
+
+多进程时每个worker每隔几秒把自己的数据写到configs.metrics.dir下的<pid>.json，
+/metrics由任意一个worker处理，它读取所有worker的文件（自己的数据用内存中的最新值）汇总后输出：
+计数器和直方图按标签相加；gauge按定义时的mode相加(sum)、取最大值(max)或者加上worker标签分别输出(all)。
+退出的worker的计数器合并到archive.json中（计数器不会因为worker重启而减少），其中的gauge被丢弃，
+所以目录中只有每个活着的worker一个文件加上archive.json；master全新启动时清空目录，reload时保留。
+'''
+
+import asyncio, fcntl, glob, json, logging, math, os, time
+
+from aiohttp import web
+
+_logger = logging.getLogger('metrics')
+
+_DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = dict() # labels tuple => value
+
+    def samples(self):
+        ' return list of (labels tuple, value). '
+        return list(self._values.items())
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+class Gauge(_Metric):
+    '''
+    Gauge, mode tells how to merge values of workers: sum, max or all (one sample per worker).
+    '''
+    kind = 'gauge'
+
+    def __init__(self, name, help, labelnames=(), mode='sum'):
+        super(Gauge, self).__init__(name, help, labelnames)
+        self.mode = mode
+
+    def set(self, value, labels=()):
+        self._values[labels] = value
+
+    def inc(self, labels=(), amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, labels=(), amount=1):
+        self._values[labels] = self._values.get(labels, 0) - amount
+
+class CallbackMetric(_Metric):
+    '''
+    Counter or gauge whose samples are read by fn() at export time: a number, or dict of labels tuple => number.
+    '''
+    def __init__(self, kind, name, help, fn, labelnames=(), mode='sum'):
+        super(CallbackMetric, self).__init__(name, help, labelnames)
+        self.kind = kind
+        self.fn = fn
+        self.mode = mode
+
+    def samples(self):
+        try:
+            v = self.fn()
+        except Exception:
+            _logger.exception('collect %s failed', self.name)
+            return []
+        if v is None:
+            return []
+        if isinstance(v, dict):
+            return list(v.items())
+        return [((), v)]
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=_DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        h = self._values.get(labels)
+        if h is None:
+            h = self._values[labels] = [[0] * len(self.buckets), 0.0, 0] # 每个桶的计数(非累计), sum, count
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                h[0][i] += 1
+                break
+        h[1] += value
+        h[2] += 1
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=(), mode='sum'):
+        return self.register(Gauge(name, help, labelnames, mode))
+
+    def histogram(self, name, help, labelnames=(), buckets=_DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def callback(self, kind, name, help, fn, labelnames=(), mode='sum'):
+        return self.register(CallbackMetric(kind, name, help, fn, labelnames, mode))
+
+    def snapshot(self, gauges=True):
+        ' return json-able dict of all metrics, gauges=False drops gauges (for exited workers). '
+        d = dict()
+        for m in self._metrics:
+            if m.kind == 'gauge' and not gauges:
+                continue
+            item = dict(kind=m.kind, help=m.help, labelnames=list(m.labelnames), samples=[[list(k), v] for k, v in m.samples()])
+            if m.kind == 'gauge':
+                item['mode'] = m.mode
+            if m.kind == 'histogram':
+                item['buckets'] = list(m.buckets)
+            d[m.name] = item
+        return d
+
+registry = Registry()
+
+requests_total = registry.counter('http_requests_total', 'HTTP requests by route, method and status.', ('route', 'method', 'status'))
+request_duration = registry.histogram('http_request_duration_seconds', 'HTTP request latency by route.', ('route', 'method'))
+requests_in_flight = registry.gauge('http_requests_in_flight', 'HTTP requests being handled.')
+
+def merge(snapshots):
+    '''
+    Merge snapshots of workers, list of (pid, snapshot), into one snapshot.
+    '''
+    merged = dict()
+    for pid, snap in snapshots:
+        for name, item in snap.items():
+            m = merged.get(name)
+            if m is None:
+                m = merged[name] = dict(item, samples=dict())
+                if item['kind'] == 'gauge' and item.get('mode') == 'all':
+                    m['labelnames'] = item['labelnames'] + ['worker']
+            samples = m['samples']
+            for labels, value in item['samples']:
+                if item['kind'] == 'gauge' and item.get('mode') == 'all':
+                    labels = labels + [str(pid)]
+                key = tuple(labels)
+                old = samples.get(key)
+                if old is None:
+                    samples[key] = value
+                elif item['kind'] == 'histogram':
+                    samples[key] = [[a + b for a, b in zip(old[0], value[0])], old[1] + value[1], old[2] + value[2]]
+                elif item['kind'] == 'gauge' and item.get('mode') == 'max':
+                    samples[key] = max(old, value)
+                else:
+                    samples[key] = old + value
+    return merged
+
+def _escape(v):
+    return str(v).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _labels(names, values, extra=None):
+    pairs = ['%s="%s"' % (n, _escape(v)) for n, v in zip(names, values)]
+    if extra is not None:
+        pairs.append('%s="%s"' % extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+def _number(v):
+    if isinstance(v, float):
+        if math.isinf(v):
+            return '+Inf' if v > 0 else '-Inf'
+        return repr(v)
+    return str(v)
+
+def render(merged):
+    ' render merged snapshot in prometheus text format 0.0.4. '
+    L = []
+    for name, item in sorted(merged.items()):
+        L.append('# HELP %s %s' % (name, item['help']))
+        L.append('# TYPE %s %s' % (name, item['kind']))
+        names = item['labelnames']
+        for labels, value in sorted(item['samples'].items()):
+            if item['kind'] == 'histogram':
+                counts, total, count = value
+                cumulative = 0
+                for bound, n in zip(item['buckets'], counts):
+                    cumulative += n
+                    L.append('%s_bucket%s %s' % (name, _labels(names, labels, ('le', _number(float(bound)))), cumulative))
+                L.append('%s_bucket%s %s' % (name, _labels(names, labels, ('le', '+Inf')), count))
+                L.append('%s_sum%s %s' % (name, _labels(names, labels), _number(total)))
+                L.append('%s_count%s %s' % (name, _labels(names, labels), count))
+            else:
+                L.append('%s%s %s' % (name, _labels(names, labels), _number(value)))
+    L.append('')
+    return '\n'.join(L)
+
+# 多进程时的数据文件
+
+_dir = None
+_interval = 5.0 # 写文件的间隔（秒）
+
+def init(directory, interval=5.0, clear=False):
+    '''
+    Enable multi-process mode: this process (and forked workers) writes snapshot into directory every interval seconds.
+    clear=True removes files of the last run (master on fresh start, not on reload).
+    '''
+    global _dir, _interval
+    os.makedirs(directory, exist_ok=True)
+    if clear:
+        for f in glob.glob(os.path.join(directory, '*.json')):
+            os.remove(f)
+    _dir = directory
+    _interval = interval
+
+_ARCHIVE = 'archive.json' # 已退出的worker的计数器合并到这个文件中
+
+def _path(pid):
+    return os.path.join(_dir, '%s.json' % pid)
+
+def write(gauges=True):
+    ' write snapshot of this process, atomically. '
+    if _dir is None:
+        return
+    _dump(registry.snapshot(gauges), _path(os.getpid()))
+
+def _dump(snap, path):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(snap, f)
+    os.replace(tmp, path)
+
+def _load(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _worker_files():
+    ' [(pid, path)] of snapshot files of workers. '
+    L = []
+    for f in glob.glob(os.path.join(_dir, '*.json')):
+        name = os.path.basename(f)[:-5]
+        if name.isdigit():
+            L.append((int(name), f))
+    return L
+
+def _without_gauges(snap):
+    return {k: v for k, v in snap.items() if v['kind'] != 'gauge'}
+
+def _archive(startup=False):
+    '''
+    Fold snapshots of exited workers into the archive file and remove them, called with the lock held.
+    startup=True also folds the file of this pid, which can only be left by an exited process with the same pid.
+    '''
+    me = os.getpid()
+    dead = [(pid, f) for pid, f in _worker_files() if (pid != me and not _alive(pid)) or (pid == me and startup)]
+    if not dead:
+        return
+    archive = os.path.join(_dir, _ARCHIVE)
+    snapshots = []
+    snap = _load(archive)
+    if snap is not None:
+        snapshots.append((0, snap))
+    for pid, f in dead:
+        snap = _load(f)
+        if snap is not None:
+            snapshots.append((pid, _without_gauges(snap))) # 异常退出的worker没有清空gauge
+    merged = merge(snapshots)
+    _dump({name: dict(item, samples=[[list(k), v] for k, v in item['samples'].items()]) for name, item in merged.items()}, archive)
+    for pid, f in dead:
+        os.remove(f)
+
+class _Lock(object):
+    '''
+    Exclusive flock on the metrics directory: archiving and reading must not interleave, or archived counters are counted twice.
+    '''
+    def __enter__(self):
+        self._f = open(os.path.join(_dir, '.lock'), 'w')
+        fcntl.flock(self._f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._f.close() # 关闭文件即释放锁
+
+def collect():
+    ''' merged snapshot of all workers (this process from memory), exited workers come from the archive file. '''
+    pid = os.getpid()
+    snapshots = [(pid, registry.snapshot())]
+    if _dir is not None:
+        with _Lock():
+            _archive()
+            archive = _load(os.path.join(_dir, _ARCHIVE))
+            if archive is not None:
+                snapshots.append((0, archive))
+            for other, f in _worker_files():
+                if other == pid:
+                    continue
+                snap = _load(f)
+                if snap is not None:
+                    snapshots.append((other, snap))
+    return merge(snapshots)
+
+async def _writer():
+    while True:
+        await asyncio.sleep(_interval)
+        try:
+            write()
+        except OSError as e:
+            _logger.warning('write metrics failed: %s', e)
+
+async def on_startup(app):
+    if _dir is not None:
+        with _Lock():
+            _archive(startup=True) # pid被重用时，不要覆盖之前退出的同pid进程的计数器
+        write()
+        app['__metrics_writer__'] = asyncio.ensure_future(_writer())
+
+async def on_cleanup(app):
+    task = app.get('__metrics_writer__')
+    if task is not None:
+        task.cancel()
+    write(gauges=False) # 保留计数器，去掉gauge
+
+def setup(app):
+    ' register startup/cleanup hooks of the snapshot writer. '
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+
+def route_of(request):
+    ' route template of the matched resource, e.g. /blog/{id}. '
+    try:
+        route = request.match_info.route
+    except AssertionError: # 还没有完成路由（watchdog、profiler从其他线程取得的request）
+        return 'unrouted'
+    if route is None or route.resource is None:
+        return 'unmatched'
+    return route.resource.canonical
+
+_METHODS = frozenset(('GET', 'HEAD', 'POST', 'PUT', 'DELETE', 'PATCH', 'OPTIONS'))
+
+def method_of(request):
+    ' request method as label, other methods sent by clients are folded into "other". '
+    return request.method if request.method in _METHODS else 'other'
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    start = time.perf_counter()
+    status = 500
+    requests_in_flight.inc()
+    try:
+        r = await handler(request)
+        status = getattr(r, 'status', 200)
+        return r
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        requests_in_flight.dec()
+        route = route_of(request)
+        method = method_of(request)
+        requests_total.inc((route, method, str(status)))
+        request_duration.observe(time.perf_counter() - start, (route, method))
+
+async def metrics_handler(request):
+    return web.Response(text=render(collect()), content_type='text/plain', charset='utf-8',
+                        headers={'Cache-Control': 'no-cache'})
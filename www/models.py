@@ -9,13 +9,14 @@ __author__ = 'Jassion Zhao'
 
 import time, uuid
 
-from orm import Model, StringField, BooleanField, FloatField, TextField
+from orm import Model, StringField, BooleanField, FloatField, TextField, IntegerField, execute
 
 def next_id(): # 以函数的形式自动生成id的默认值
     return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)
 
 class User(Model):
     __table__ = 'users'
+    __indexes__ = (('idx_created_at', ('created_at',)),)
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     email = StringField(ddl='varchar(50)')
@@ -36,16 +37,32 @@ class Blog(Model):
     summary = StringField(ddl='varchar(200)')
     content = TextField()
     created_at = FloatField(default=time.time)
+    updated_at = FloatField(default=time.time) # 日志或其评论发生变化的时间，用于条件GET(Last-Modified)
+    comment_count = IntegerField() # 评论数，随评论的增删维护，不需要每次count
+
+    __indexes__ = (('idx_created_at', ('created_at',)),)
+
+    @classmethod
+    async def add_comments(cls, blog_id, n):
+        ' atomically change comment_count by n and bump updated_at. '
+        rows = await execute('update `blogs` set `comment_count`=`comment_count`+?, `updated_at`=? where `id`=?', [n, time.time(), blog_id])
+        return rows
 
 class Comment(Model):
     __table__ = 'comments'
 
+    __indexes__ = (
+        ('idx_created_at', ('created_at',)),
+        ('idx_blog_created_at', ('blog_id', 'created_at')) # 按日志分页查询评论
+    )
+
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     blog_id = StringField(ddl='varchar(50)')
     user_id = StringField(ddl='varchar(50)')
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     content = TextField()
+    html_content = TextField(default='') # 写入时渲染好的HTML，读取时不需要再转换
     created_at = FloatField(default=time.time)
 
 '''
@@ -77,17 +94,16 @@ if __name__ == '__main__':
 
     loop = asyncio.get_event_loop()
 
-    @asyncio.coroutine
-    def test():
-        yield from orm.create_pool(loop=loop, user='www-data', password='www-data', database='db_web')
+    async def test():
+        await orm.create_pool(loop=loop, user='www-data', password='www-data', database='db_web')
         # user = User(name='Test', email='test@example.com', passwd='1234567890', image='about:blank') # 在users表中增加一项数据
-        # yield from user.save()
+        # await user.save()
         user = User(name='Huan', email='huan@example.com', passwd='1234567890', image='about:blank')
-        yield from user.save()
+        await user.save()
         user = User(name='Qiang', email='qiang@example.com', passwd='1234567890', image='about:blank')
-        yield from user.save()
+        await user.save()
         user = User(name='Admin', email='admin@163.com', passwd='123456', image='about:blank', admin=True)
-        yield from user.save()
+        await user.save()
   
     # tasks = [test()]
     loop.run_until_complete(test())
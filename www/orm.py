@@ -15,14 +15,17 @@ Web App里面有很多地方都要访问数据库。访问数据库需要创建
 幸运的是aiomysql为MySQL数据库提供了异步IO的驱动。
 '''
 
-import asyncio, logging
-import aiomysql
+import asyncio, logging, time
 from config import configs
+from dbdrivers import get_driver
+import querylog, timing
 
 # 一次使用异步 处处使用异步
 
+_logger = logging.getLogger('orm') # SQL日志在请求的热路径上，单独分类，级别和采样率见configs.logging
+
 def loginfo(sql, args=()):
-    logging.info('SQL: %s' % sql)
+    _logger.info('SQL: %s', sql) # 惰性格式化，级别不够时不会拼接字符串
 
 
 '''
@@ -32,30 +35,32 @@ def loginfo(sql, args=()):
 
 连接池由全局变量__pool存储，缺省情况下将编码设置为utf8，自动提交事务：
 aiomysql：https://aiomysql.readthedocs.io/en/latest/tutorial.html
+
+__pool现在是一个driver对象（见dbdrivers.py），由kw中的driver参数决定：
+driver='mysql'  : 默认值，使用aiomysql连接池
+driver='sqlite' : 使用sqlite3，database是数据库文件路径（或':memory:'），并根据已定义的Model自动建表
 '''
-@asyncio.coroutine
-def create_pool(loop, **kw):
+__pool = None
+
+async def create_pool(loop, **kw):
     logging.info('create database connection pool...')
     global __pool
-    __pool = yield from aiomysql.create_pool( # yield from 将会调用一个子协程，并直接返回调用的结果
-        host=kw.get('host', 'localhost'),
-        port=kw.get('port', configs.db.port),
-        user=kw['user'],
-        password=kw['password'],
-        db=kw['database'],
-        charset=kw.get('charset', 'utf8'),
-        autocommit=kw.get('autocommit', True),
-        maxsize=kw.get('maxsize', 10),
-        minsize=kw.get('minsize', 1),
-        loop=loop
-    )
-
-@asyncio.coroutine
-def destroy_pool():
+    driver = get_driver(kw.get('driver', 'mysql'))
+    kw.setdefault('port', configs.db.port)
+    await driver.create_pool(loop, **kw) # await 将会调用一个子协程，并直接返回调用的结果
+    __pool = driver
+    if kw.get('create_tables', driver.name == 'sqlite'):
+        await create_tables()
+
+async def destroy_pool():
     global __pool
-    if __pool is not None: # 通过aiomysql.create_pool创建的pool都具有如下的功能，且如下是标准的关闭Pool的步骤
-        __pool.close()
-        yield from __pool.wait_closed()
+    if __pool is not None:
+        await __pool.close()
+        __pool = None
+
+def pool_stats():
+    ' connections of the current pool, see Driver.stats(). '
+    return __pool.stats() if __pool is not None else dict()
 
 
 
@@ -64,26 +69,24 @@ Select
 
 要执行SELECT语句，我们用select函数执行，需要传入SQL语句和SQL参数
 
-SQL语句的占位符是?，而MySQL的占位符是%s，select()函数在内部自动替换。注意要始终坚持使用带参数的SQL，而不是自己拼接SQL字符串，这样可以防止SQL注入攻击。
+SQL语句的占位符是?，而MySQL的占位符是%s，由MySQLDriver在内部自动替换。注意要始终坚持使用带参数的SQL，而不是自己拼接SQL字符串，这样可以防止SQL注入攻击。
 
-注意到yield from将调用一个子协程（也就是在一个协程中调用另一个协程）并直接获得子协程的返回结果。
+注意到await将调用一个子协程（也就是在一个协程中调用另一个协程）并直接获得子协程的返回结果。
 
 如果传入size参数，就通过fetchmany()获取最多指定数量的记录，否则，通过fetchall()获取所有记录。
 '''
-@asyncio.coroutine
-def select(sql, args, size=None): # 全局对象（实例）的select()，传进来的sql就是一条完整的sql语句，args是在sql语句中占位符对应的数值数据
+async def select(sql, args, size=None): # 全局对象（实例）的select()，传进来的sql就是一条完整的sql语句，args是在sql语句中占位符对应的数值数据
     loginfo(sql, args)
-    global __pool
-    with (yield from __pool) as conn:
-        cur = yield from conn.cursor(aiomysql.DictCursor)
-        yield from cur.execute(sql.replace('?', '%s'), args or ()) # 将sql语句的占位符？替换为所使用的数据库Mysql的占位符%s，然后执行该sql语句
-        if size:
-            rs = yield from cur.fetchmany(size)
-        else:
-            rs = yield from cur.fetchall()
-        yield from cur.close()
-        logging.info('rows returned: %s' % len(rs))
-        return rs
+    start = time.time()
+    try:
+        with timing.span('db'):
+            rs = await __pool.select(sql, args, size)
+    except BaseException as e:
+        querylog.record(sql, args, time.time() - start, 0, error=True)
+        raise
+    _logger.info('rows returned: %s', len(rs))
+    querylog.record(sql, args, time.time() - start, len(rs), __pool) # 累计统计，超过阈值的SQL还会进入慢查询日志
+    return rs
 
 '''
 Insert, Update, Delete
@@ -91,24 +94,40 @@ Insert, Update, Delete
 要执行INSERT、UPDATE、DELETE语句，可以定义一个通用的execute()函数，因为这3种SQL的执行都需要相同的参数，以及返回一个整数表示影响的行数
 execute()函数和select()函数所不同的是，cursor对象不返回结果集，而是通过rowcount返回结果数
 '''
-@asyncio.coroutine
-def execute(sql, args, autocommit=True):  # 全局对象（实例）的execute()
+async def execute(sql, args, autocommit=True):  # 全局对象（实例）的execute()
     loginfo(sql, args)
-    with (yield from __pool) as conn:
-        if not autocommit:
-            yield from conn.begin() # 若是不允许autocommit，则在开始处标记此次connection的位置，为了之后的回滚操作rollback所做的标记
-        try:
-            cur = yield from conn.cursor()
-            yield from cur.execute(sql.replace('?', '%s'), args)
-            affected = cur.rowcount
-            yield from cur.close()
-            if not autocommit:
-                yield from conn.commit()
-        except BaseException as e:
-            if not autocommit:
-                yield from conn.rollback()
-            raise
-        return affected
+    start = time.time()
+    try:
+        with timing.span('db'):
+            affected = await __pool.execute(sql, args, autocommit)
+    except BaseException as e:
+        querylog.record(sql, args, time.time() - start, 0, error=True)
+        raise
+    querylog.record(sql, args, time.time() - start, affected, __pool)
+    return affected
+
+# 所有定义过的Model子类，由ModelMetaclass登记，用于自动建表
+__models__ = []
+
+def create_table_sql(cls):
+    ' generate create table statement by Model class. '
+    mappings = cls.__mappings__
+    columns = ['`%s` %s not null' % (k, mappings[k].column_type) for k in [cls.__primary_key__] + cls.__fields__]
+    columns.append('primary key (`%s`)' % cls.__primary_key__)
+    return 'create table if not exists `%s` (%s)' % (cls.__table__, ', '.join(columns))
+
+def create_index_sqls(cls):
+    ' generate create index statements by __indexes__ of Model class, e.g. __indexes__ = ((\'idx_name\', (\'col1\', \'col2\')),) '
+    # sqlite中索引名在整个数据库内唯一，所以加上表名作为前缀
+    return ['create index if not exists `%s_%s` on `%s` (%s)' % (cls.__table__, name, cls.__table__, ', '.join('`%s`' % c for c in columns)) for name, columns in getattr(cls, '__indexes__', ())]
+
+async def create_tables():
+    ' create tables for all defined models, used by drivers without schema.sql (e.g. sqlite). '
+    sqls = []
+    for cls in __models__:
+        sqls.append(create_table_sql(cls))
+        sqls.extend(create_index_sqls(cls))
+    await __pool.execute_script(sqls)
 
 # 生成num个“?”,并且以“,”分割，生成对应与sql语句args参数中参数个数的占位符
 # 比如说：insert into  `User` (`password`, `email`, `name`, `id`) values (?,?,?,?) 
@@ -287,10 +306,12 @@ class ModelMetaclass(type):
         attrs['__fields__'] = fields # 除主键外的属性名
         # 构造默认的SELECT，INSERT，UPDATE和DELETE语句：
         attrs['__select__'] = 'select `%s`, %s from `%s`' % (primaryKey, ', '.join(escaped_fields), tableName)
-        attrs['__insert__'] = 'insert into `%s` (%s, `%s`) value (%s)' % (tableName, ', '.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
+        attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (tableName, ', '.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
         attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
-        return type.__new__(cls, name, bases, attrs)  # 在__init__执行之前，将通过__new__重新构造的类返回
+        model = type.__new__(cls, name, bases, attrs)  # 在__init__执行之前，将通过__new__重新构造的类返回
+        __models__.append(model)
+        return model
 # 这样，任何继承自Model的类（比如User），会自动通过ModelMetaclass扫描映射关系，并存储到自身的类属性如__table__、__mappings__中
 '''
 1. ', '.join(escaped_fields)
@@ -341,8 +362,7 @@ class Model(dict, metaclass=ModelMetaclass):
     # 一般来说，要使用某个类的方法，需要先实例化一个对象再调用方法。
     # 而使用@staticmethod或@classmethod，就可以不需要实例化，直接类名.方法名()来调用。
     @classmethod
-    @asyncio.coroutine
-    def findAll(cls, where=None, args=None, **kw):
+    async def findAll(cls, where=None, args=None, **kw):
         ' find objects by where clause. '
         sql = [cls.__select__]
         if where:
@@ -365,7 +385,7 @@ class Model(dict, metaclass=ModelMetaclass):
                 args.extend(limit)
             else:
                 raise ValueError('Invalid limit value: %s' % str(limit))
-        rs = yield from select(' '.join(sql), args) #返回的rs是一个元素是tuple的list
+        rs = await select(' '.join(sql), args) #返回的rs是一个元素是tuple的list
         return [cls(**r) for r in rs]  # 将select返回的rs(在Mysql中找到的数据)中的每一行数据(对应的类实例))组织成dict，再将所有的dict组织成一个列表List，通过cls返回给子类的对象
 ## cls(**r)相当于将r用当前class实例化
 
@@ -375,49 +395,44 @@ class Model(dict, metaclass=ModelMetaclass):
 
 
     @classmethod
-    @asyncio.coroutine
-    def findNumber(cls, selectField, where=None, args=None):
+    async def findNumber(cls, selectField, where=None, args=None):
         ' find number by select and where. '
         sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)] # 在Mysql中， 将selectField的结果保存在返回的表的_num_属性中， 因为这里会为selectField传入 count(id)，即统计id列的记录数
         if where: # 这里若没有_num_，那返回的记录数就会保存在一个表的属性中，且该属性是：selectField中的值（是一个字符串）
             sql.append('where') # 若上一句注释中所说的传入的selectField=‘count(id)’，则最终的返回值应该是：rs[0]['count(id)']
             sql.append(where)
-        rs = yield from select(' '.join(sql), args, 1) # 返回的是一个表，包括多行已经每一行有多个属性
+        rs = await select(' '.join(sql), args, 1) # 返回的是一个表，包括多行已经每一行有多个属性
         if len(rs) == 0:
             return None
         return rs[0]['_num_'] # 取返回的表的第一行的_num_属性的值
 
     @classmethod
-    @asyncio.coroutine
-    def find(cls, pk):
+    async def find(cls, pk):
         ' find object by primary key. '
         #rs是一个list，里面是一个dict
-        rs = yield from select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
+        rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
         if len(rs) == 0:
             return None
         return cls(**rs[0]) #只返回rs中的第一个dict，也就是只返回第一个找到的Field实例，即找到的第一行数据
 
     # 往Model类添加实例方法，就可以让所有子类调用实例方法
-    @asyncio.coroutine
-    def save(self):
+    async def save(self):
         args = list(map(self.getValueOrDefault, self.__fields__)) # 把非主键Filed实例与对应的当前value组成dict，并放在一个list中
         args.append(self.getValueOrDefault(self.__primary_key__)) # 在该list中加入主键对应的value
-        rows = yield from execute(self.__insert__, args) # 调用__insert__，将该组Field值写如Mysql中
+        rows = await execute(self.__insert__, args) # 调用__insert__，将该组Field值写如Mysql中
         if rows != 1:
             logging.warn('failed to insert record: affected rows: %s' % rows)
 
-    @asyncio.coroutine
-    def update(self): # 该Field已存在，更新其对应的值
+    async def update(self): # 该Field已存在，更新其对应的值
         args = list(map(self.getValue, self.__fields__)) # getValue得到的是对应table的某一行数据各列属性的当前值
         args.append(self.getValue(self.__primary_key__))
-        rows = yield from execute(self.__update__, args)
+        rows = await execute(self.__update__, args)
         if rows != 1:
             logging.warn('failed to update by primary key: affected rows: %s' % rows)
 
-    @asyncio.coroutine
-    def remove(self): # 通过主键来删除某一个Field实例
+    async def remove(self): # 通过主键来删除某一个Field实例
         args = [self.getValue(self.__primary_key__)]
-        rows = yield from execute(self.__delete__, args)
+        rows = await execute(self.__delete__, args)
         if rows != 1:
             logging.warn('failed to remove by primary key: affected rows: %s' % rows)
 
@@ -425,12 +440,11 @@ class Model(dict, metaclass=ModelMetaclass):
 
 
 if __name__=='__main__': #一个类自带前后都有双下划线的方法，在子类继承该类的时候，这些方法会自动调用，比如__init__
-    import sys
+    import sys, aiomysql
 #    import pymysql
-# 关于协程，@asyncio.coroutine 与 yield from 配对使用，前者标识一个函数是协程，后者在一个协程中调用另一个协程前使用
-#          async 与 await 配对使用，前者标识一个函数是协程，后者在一个协程中调用另一个协程前使用
-#     且 yield from 与 await 必须在一个协程中调用另一个协程时使用，不可在普通函数中使用(SyntaxError:'yield' inside function)
-#     也不可在所有函数外使用（SyntaxError:'yield' outside function）
+# 关于协程，async 与 await 配对使用，前者标识一个函数是协程，后者在一个协程中调用另一个协程前使用
+#     且 await 只能在协程中使用，不可在普通函数中使用(SyntaxError:'await' outside async function)
+#     也不可在所有函数外使用（SyntaxError:'await' outside function）
 
     Create_Database_test = '''
         CREATE DATABASE if not exists test  
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jassion Zhao'
+
+'''
+pre-fork multi-process server.
+
+一个事件循环只能用满一个CPU核。Master在启动时创建监听socket，然后fork出N个worker进程，
+每个worker运行自己的事件循环和数据库连接池，在继承来的同一个socket上accept：
+
+$ python3 app.py --workers 4
+
+reuse_port=True时master不创建socket，每个worker用SO_REUSEPORT各自绑定同一个地址，
+由内核把新连接均匀地分给各个worker（Linux 3.9+）。
+
+nginx和app在同一台机器上时可以改用Unix domain socket(bind_unix_socket)，省去TCP/IP协议栈的开销：
+所有worker共享master创建的一个socket文件，或者每个worker一个socket文件，由nginx的upstream做负载均衡。
+
+fork之前master先import并初始化好所有模块（路由表、编译好的模板、markdown转换器等），再调用gc.freeze()：
+这些对象所在的内存页由所有worker共享（copy-on-write），gc.freeze()把它们移出垃圾回收的范围，
+worker中的gc不会再去修改它们的对象头，页面就不会被复制。worker的独占内存(USS)定期记录在日志中。
+
+master自己不处理请求，只管理worker：
+SIGTERM/SIGINT  向所有worker发送SIGTERM，等它们处理完进行中的请求后退出，超时仍未退出的worker用SIGKILL结束
+SIGHUP          平滑重启(reload)：先用check命令确认新代码能正常加载，然后master用exec重新执行自己（pid不变，
+                supervisor感知不到），监听socket和旧worker的pid通过环境变量传给新的master；
+                新master用新代码fork出新的worker，等它们都调用了notify_ready()之后，才让旧worker退出
+worker退出      重新fork一个；启动后很快就退出的worker延迟重启（延迟逐次加倍），避免代码出错时不停地fork
+
+reload时master按启动时的sys.argv[0]重新执行，并切换到它所在的目录：部署时替换了www软链接，
+supervisor的command就要使用经过软链接的绝对路径（如 python3 /srv/jsnwebapp/www/app.py），才会加载新版本。
+'''
+
+import gc, logging, os, signal, socket, stat, subprocess, sys, time
+
+import applog
+
+_logger = logging.getLogger('prefork')
+
+_MIN_UPTIME = 5.0         # 运行时间短于该值就退出的worker，视为启动失败
+_MAX_RESTART_DELAY = 30.0
+_STOP_TIMEOUT = 30.0      # 停止时等待worker退出的时间
+_MEMORY_REPORT_DELAY = 10.0      # worker启动后多久第一次记录内存
+_MEMORY_REPORT_INTERVAL = 600.0
+_READY_TIMEOUT = 60.0     # reload时等待新worker就绪的时间，超时则保留旧worker
+
+_SIGNALS = {signal.SIGTERM, signal.SIGINT, signal.SIGCHLD, signal.SIGHUP}
+
+_ENV_FD = 'PREFORK_FD'             # reload时传给新master的监听socket
+_ENV_OLD_PIDS = 'PREFORK_OLD_PIDS' # reload时传给新master的旧worker
+
+_ready_fd = None # worker中：通知master已就绪的管道
+
+def notify_ready():
+    '''
+    Called by worker when it is accepting requests. Does nothing outside a forked worker.
+    '''
+    global _ready_fd
+    if _ready_fd is not None:
+        os.write(_ready_fd, b'%d\n' % os.getpid())
+        os.close(_ready_fd)
+        _ready_fd = None
+
+def inherited():
+    '''
+    Return (sock, old_pids) passed by the master before reload, (None, []) on normal start.
+    '''
+    fd = os.environ.pop(_ENV_FD, None)
+    pids = os.environ.pop(_ENV_OLD_PIDS, '')
+    sock = None
+    if fd:
+        sock = socket.socket(fileno=int(fd))
+        sock.set_inheritable(False)
+        sock.setblocking(False)
+    return sock, [int(pid) for pid in pids.split(',') if pid]
+
+def cpu_count():
+    ' number of cpus this process may run on. '
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def memory_usage(pid):
+    '''
+    Return dict of rss, pss and uss (unique set size) in bytes from /proc/<pid>/smaps_rollup, or None.
+    '''
+    try:
+        with open('/proc/%s/smaps_rollup' % pid) as f:
+            lines = f.readlines()
+    except OSError: # 非Linux或内核太旧
+        return None
+    kb = dict()
+    for line in lines:
+        parts = line.split()
+        if len(parts) == 3 and parts[2] == 'kB':
+            kb[parts[0].rstrip(':')] = int(parts[1])
+    return dict(rss=kb.get('Rss', 0) * 1024, pss=kb.get('Pss', 0) * 1024,
+                uss=(kb.get('Private_Clean', 0) + kb.get('Private_Dirty', 0)) * 1024)
+
+def bind_unix_socket(path, mode=0o660, backlog=128):
+    '''
+    Create a listening unix domain socket at path, replacing the socket file left by a previous process.
+    '''
+    if os.path.exists(path):
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            raise OSError('%s exists and is not a socket.' % path)
+        os.unlink(path) # 旧进程（或reload前的worker）的socket文件，新的连接从此由这个socket接收
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    os.chmod(path, mode) # nginx需要有写权限才能连接
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+def bind_socket(host, port, reuse_port=False, backlog=128):
+    ' create a listening tcp socket, which can be passed to web.SockSite. '
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+class Master(object):
+    '''
+    Fork and supervise worker processes, target(worker_id, sock) runs in each worker.
+
+    check: command line run before reload, reload is cancelled if it does not exit with 0.
+    old_pids: workers of the master before reload, retired once the new workers are ready.
+    '''
+    def __init__(self, target, workers, sock=None, stop_timeout=_STOP_TIMEOUT, check=None, old_pids=()):
+        self.target = target
+        self.workers = workers
+        self.sock = sock # None表示worker自己绑定地址（reuse_port）
+        self.stop_timeout = stop_timeout
+        self.check = check
+        self._old = set(old_pids)
+        self._retire_at = None # 旧worker收到SIGTERM后，超过该时间仍未退出就SIGKILL
+        self._waiting = set()  # 还没有就绪的新worker
+        self._ready_timeout = None
+        self._ready_r, self._ready_w = os.pipe()
+        os.set_blocking(self._ready_r, False)
+        self._ready_buf = b''
+        self._pids = dict()    # pid => worker_id
+        self._started = dict() # worker_id => 启动时间
+        self._delays = dict()  # worker_id => 下次重启前的延迟
+        self._pending = dict() # worker_id => 计划重启的时间
+        self._report_at = None
+
+    def spawn(self, worker_id):
+        pid = os.fork()
+        if pid == 0:
+            global _ready_fd
+            code = 1
+            try:
+                os.close(self._ready_r)
+                _ready_fd = self._ready_w
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                signal.pthread_sigmask(signal.SIG_UNBLOCK, _SIGNALS)
+                self.target(worker_id, self.sock)
+                code = 0
+            except BaseException:
+                _logger.exception('worker %s failed.', worker_id)
+            finally:
+                applog.stop_logging() # os._exit不会执行atexit，先把队列中的日志写完
+                os._exit(code)
+        self._pids[pid] = worker_id
+        self._started[worker_id] = time.time()
+        _logger.info('worker %s started, pid %s.', worker_id, pid)
+        return pid
+
+    def reap(self):
+        ' collect exited workers, return list of their worker ids. '
+        exited = []
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            if pid in self._old:
+                self._old.discard(pid)
+                _logger.info('old worker pid %s exited.', pid)
+                continue
+            self._waiting.discard(pid)
+            worker_id = self._pids.pop(pid, None)
+            if worker_id is None:
+                continue
+            code = os.waitstatus_to_exitcode(status)
+            _logger.log(logging.INFO if code == 0 else logging.WARNING, 'worker %s (pid %s) exited with code %s.', worker_id, pid, code)
+            exited.append(worker_id)
+        return exited
+
+    def _schedule_restart(self, worker_id):
+        now = time.time()
+        if now - self._started.get(worker_id, now) < _MIN_UPTIME:
+            delay = min(max(self._delays.get(worker_id, 0.5) * 2, 1.0), _MAX_RESTART_DELAY)
+        else:
+            delay = 0.0
+        self._delays[worker_id] = delay
+        self._pending[worker_id] = now + delay
+        if delay:
+            _logger.warning('worker %s exited too soon, restart in %.0fs.', worker_id, delay)
+
+    def _restart_pending(self):
+        now = time.time()
+        for worker_id, at in list(self._pending.items()):
+            if at <= now:
+                del self._pending[worker_id]
+                self.spawn(worker_id)
+
+    def report_memory(self):
+        ' log memory usage of master and workers. '
+        L = []
+        for pid, worker_id in sorted(self._pids.items(), key=lambda x: x[1]):
+            m = memory_usage(pid)
+            if m is not None:
+                L.append('worker %s uss=%.1fM pss=%.1fM rss=%.1fM' % (worker_id, m['uss'] / 1048576, m['pss'] / 1048576, m['rss'] / 1048576))
+        m = memory_usage(os.getpid())
+        if m is not None:
+            _logger.info('memory: master rss=%.1fM; %s', m['rss'] / 1048576, '; '.join(L))
+
+    def _next_timeout(self):
+        timeout = 0.2 if self._waiting else 1.0
+        if not self._pending:
+            return timeout
+        return max(0.0, min(timeout, min(self._pending.values()) - time.time()))
+
+    def _read_ready(self):
+        try:
+            data = os.read(self._ready_r, 4096)
+        except BlockingIOError:
+            return
+        lines = (self._ready_buf + data).split(b'\n')
+        self._ready_buf = lines.pop()
+        for line in lines:
+            self._waiting.discard(int(line))
+
+    def _retire_old(self):
+        ' terminate old workers once all new workers are ready, kill them after stop_timeout. '
+        if not self._old:
+            self._retire_at = None
+            return
+        now = time.time()
+        if self._retire_at is None:
+            if self._waiting:
+                if now >= self._ready_timeout:
+                    _logger.error('new workers not ready in %ss, old workers %s kept running.', _READY_TIMEOUT, sorted(self._old))
+                    self._waiting.clear()
+                    self._ready_timeout = float('inf')
+                return
+            if self._ready_timeout == float('inf'): # 新worker启动失败，旧worker继续服务
+                return
+            _logger.info('new workers ready, retiring old workers %s.', sorted(self._old))
+            for pid in list(self._old):
+                self._kill_old(pid, signal.SIGTERM)
+            self._retire_at = now + self.stop_timeout
+        elif now >= self._retire_at:
+            for pid in list(self._old):
+                _logger.warning('old worker pid %s did not stop in %ss, killed.', pid, self.stop_timeout)
+                self._kill_old(pid, signal.SIGKILL)
+            self._retire_at = None
+
+    def _kill_old(self, pid, sig):
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            self._old.discard(pid)
+
+    def reload(self):
+        '''
+        Re-exec the master with the code on disk, keeping the pid, the listening socket and the workers until the new ones are ready.
+        '''
+        if self._old:
+            _logger.warning('reload ignored, old workers %s are still running.', sorted(self._old))
+            return
+        workdir = os.path.dirname(os.path.abspath(sys.argv[0]))
+        if self.check is not None:
+            r = subprocess.run(self.check, cwd=workdir)
+            if r.returncode != 0:
+                _logger.error('reload cancelled, check failed with code %s: %s', r.returncode, ' '.join(self.check))
+                return
+        _logger.info('master %s reloading from %s...', os.getpid(), workdir)
+        if self.sock is not None:
+            self.sock.set_inheritable(True)
+            os.environ[_ENV_FD] = str(self.sock.fileno())
+        os.environ[_ENV_OLD_PIDS] = ','.join(str(pid) for pid in self._pids)
+        applog.stop_logging()
+        os.chdir(workdir)
+        os.execv(sys.executable, [sys.executable] + sys.argv) # 被阻塞的信号和子进程都会保留到新的程序中
+
+    def run(self):
+        '''
+        Fork workers and supervise them until SIGTERM or SIGINT.
+        '''
+        # 信号先阻塞，用sigtimedwait同步地处理；SIGCHLD默认被忽略，需要一个处理函数它才会被排队
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.pthread_sigmask(signal.SIG_BLOCK, _SIGNALS)
+        # 到这里master已经加载好了所有模块和数据，之后的垃圾回收不再扫描这些对象，fork出的worker与master共享它们的内存页
+        gc.collect()
+        gc.freeze()
+        _logger.info('master %s starting %s workers, %s objects frozen.', os.getpid(), self.workers, gc.get_freeze_count())
+        for worker_id in range(self.workers):
+            self.spawn(worker_id)
+        if self._old:
+            _logger.info('reloaded, old workers %s retire when new workers are ready.', sorted(self._old))
+            self._waiting = set(self._pids)
+            self._ready_timeout = time.time() + _READY_TIMEOUT
+        self._report_at = time.time() + _MEMORY_REPORT_DELAY
+        try:
+            while True:
+                info = signal.sigtimedwait(_SIGNALS, self._next_timeout())
+                if info is not None and info.si_signo in (signal.SIGTERM, signal.SIGINT):
+                    break
+                if info is not None and info.si_signo == signal.SIGHUP:
+                    self.reload() # 成功时不会返回
+                for worker_id in self.reap():
+                    self._schedule_restart(worker_id)
+                self._restart_pending()
+                self._read_ready()
+                self._retire_old()
+                if time.time() >= self._report_at:
+                    self.report_memory()
+                    self._report_at = time.time() + _MEMORY_REPORT_INTERVAL
+        finally:
+            self.stop()
+
+    def stop(self):
+        ' send SIGTERM to all workers and wait, kill those still running after stop_timeout. '
+        self._pending.clear()
+        for pid in list(self._pids):
+            self._kill(pid, signal.SIGTERM)
+        for pid in list(self._old):
+            self._kill_old(pid, signal.SIGTERM)
+        deadline = time.time() + self.stop_timeout
+        while (self._pids or self._old) and time.time() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in list(self._pids):
+            _logger.warning('worker pid %s did not stop in %ss, killed.', pid, self.stop_timeout)
+            self._kill(pid, signal.SIGKILL)
+        for pid in list(self._old):
+            self._kill_old(pid, signal.SIGKILL)
+        self.reap()
+        _logger.info('master %s stopped.', os.getpid())
+
+    def _kill(self, pid, sig):
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            self._pids.pop(pid, None)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jassion Zhao'
+
+'''
+on-demand profiler of a live worker, used by /manage/api/profile.
+
+两种模式，每个worker同一时间只运行一个：
+
+cpu   : 采样线程每隔约interval秒用sys._current_frames()取一次事件循环线程的调用栈，持续seconds秒，
+        结果是collapsed stacks格式（每行"栈帧;栈帧;... 次数"），可以直接交给flamegraph.pl或speedscope：
+
+            curl -b cookie 'http://127.0.0.1:9000/manage/api/profile?seconds=10' > cpu.collapsed
+            flamegraph.pl cpu.collapsed > cpu.svg
+
+        栈的最外层是正在处理的请求的路由（如"GET /blog/{id}"），没有请求时是"no request"（大多是事件循环在等待IO）。
+alloc : 用tracemalloc记录seconds秒内的内存分配，返回结束时仍未释放的分配，按路由（handler函数或模板）汇总，
+        每个路由列出分配最多的代码行。tracemalloc会让worker明显变慢，只在需要时短时间运行。
+
+采样线程不修改事件循环，开销只有采样本身；多进程时结果只是处理这个请求的worker的（响应中有pid）。
+'''
+
+import asyncio, collections, functools, inspect, os, random, sys, threading, time, tracemalloc
+
+import metrics
+from watchdog import walk, find_request
+
+_running = False
+
+def running():
+    return _running
+
+@functools.lru_cache(maxsize=1024)
+def _short(filename):
+    ' filename relative to the longest sys.path entry containing it. '
+    for p in sorted((p for p in sys.path if p), key=len, reverse=True):
+        if filename.startswith(p.rstrip(os.sep) + os.sep):
+            return filename[len(p.rstrip(os.sep)) + 1:]
+    return os.path.basename(filename)
+
+def _label(code):
+    return '%s (%s:%d)' % (code.co_name, _short(code.co_filename), code.co_firstlineno)
+
+def _stack(frame):
+    ' collapsed stack of frame: route of the request, then frames from outermost to innermost. '
+    frames = walk(frame)
+    request = find_request(frames)
+    L = ['%s %s' % (request.method, metrics.route_of(request)) if request is not None else 'no request']
+    L.extend(_label(f.f_code) for f, lineno in reversed(frames))
+    return ';'.join(L)
+
+def sample(thread_id, seconds, interval=0.01):
+    '''
+    Sample stacks of thread_id for seconds, return Counter of collapsed stack => samples.
+    '''
+    counts = collections.Counter()
+    me = threading.get_ident()
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None and thread_id != me:
+            counts[_stack(frame)] += 1
+        del frame
+        time.sleep(interval * (0.5 + random.random())) # 随机间隔，避免与周期性的任务（如watchdog心跳）同步
+    return counts
+
+def collapsed(counts):
+    ' text of collapsed stacks, most frequent first. '
+    return ''.join('%s %d\n' % (stack, n) for stack, n in counts.most_common())
+
+def _handler_ranges(module):
+    ' filename => list of (first line, last line, route) of handler functions in module. '
+    ranges = collections.defaultdict(list)
+    for name in dir(module):
+        fn = getattr(module, name)
+        route = getattr(fn, '__route__', None)
+        if route is None or not callable(fn):
+            continue
+        code = inspect.unwrap(fn).__code__
+        last = max((l for _, _, l in code.co_lines() if l is not None), default=code.co_firstlineno)
+        ranges[code.co_filename].append((code.co_firstlineno, last, '%s %s' % (fn.__method__, route)))
+    return ranges
+
+def _route_of_trace(traceback, ranges):
+    for frame in reversed(traceback): # 从最内层开始
+        for first, last, route in ranges.get(frame.filename, ()):
+            if first <= frame.lineno <= last:
+                return route
+        if frame.filename.endswith('.html'): # jinja2编译后的模板代码，文件名是模板路径
+            return 'template %s' % os.path.basename(frame.filename)
+    return 'other'
+
+def allocations(snapshot, module, limit=10):
+    '''
+    Group traces of snapshot by route of handlers in module (or template), with top `limit` allocation sites of each.
+    '''
+    ranges = _handler_ranges(module)
+    routes = dict() # route => [size, count, Counter(site => size), Counter(site => count)]
+    for trace in snapshot.traces:
+        route = _route_of_trace(trace.traceback, ranges)
+        r = routes.get(route)
+        if r is None:
+            r = routes[route] = [0, 0, collections.Counter(), collections.Counter()]
+        frame = trace.traceback[-1]
+        site = '%s:%d' % (_short(frame.filename), frame.lineno)
+        r[0] += trace.size
+        r[1] += 1
+        r[2][site] += trace.size
+        r[3][site] += 1
+    L = []
+    for route, (size, count, sizes, counts) in sorted(routes.items(), key=lambda kv: kv[1][0], reverse=True):
+        sites = [dict(site=site, size=s, count=counts[site]) for site, s in sizes.most_common(limit)]
+        L.append(dict(route=route, size=size, count=count, sites=sites))
+    return L
+
+_TRACE_FRAMES = 30 # 需要足够深才能从分配点回溯到handler
+
+async def profile_cpu(seconds, interval=0.01):
+    ' sample the event loop thread for seconds, return collapsed stacks text. '
+    global _running
+    _running = True
+    switch = sys.getswitchinterval()
+    sys.setswitchinterval(min(switch, interval / 10)) # 采样线程需要拿到GIL，缩短切换间隔，减少采样点偏向释放GIL的位置（IO）
+    try:
+        counts = await asyncio.get_event_loop().run_in_executor(None, sample, threading.get_ident(), seconds, interval)
+    finally:
+        sys.setswitchinterval(switch)
+        _running = False
+    return collapsed(counts)
+
+async def profile_alloc(seconds, module, limit=10):
+    ' trace allocations for seconds, return allocations() of those still alive at the end. '
+    global _running
+    _running = True
+    started = not tracemalloc.is_tracing() # 用PYTHONTRACEMALLOC启动时不要关闭
+    try:
+        if started:
+            tracemalloc.start(_TRACE_FRAMES)
+        else:
+            tracemalloc.clear_traces() # 只保留这段时间内的分配
+        await asyncio.sleep(seconds)
+        snapshot = tracemalloc.take_snapshot()
+    finally:
+        if started:
+            tracemalloc.stop()
+        _running = False
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+    return await asyncio.get_event_loop().run_in_executor(None, allocations, snapshot, module, limit)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jassion Zhao'
+
+'''
+slow query log and query digest statistics for orm.
+
+orm.select()/orm.execute()执行完每条SQL后调用record()：
+1. 耗时超过configs.slowquery.threshold(秒)的SQL会被记录到一个环形缓冲区中，
+   每种新出现的SQL形状(shape)还会在后台通过driver的旁路连接执行一次EXPLAIN，执行计划保存在记录里。
+2. 所有SQL按shape归类(digest)，累计执行次数、耗时、返回行数和出错次数，类似pg_stat_statements。
+'''
+
+import asyncio, collections, functools, hashlib, logging, re, time
+
+from config import configs
+
+_logger = logging.getLogger('orm')
+
+_RE_SPACES = re.compile(r'\s+')
+_RE_STRING = re.compile(r"'(?:[^'\\]|\\.)*'")
+_RE_NUMBER = re.compile(r'\b\d+(\.\d+)?\b')
+
+@functools.lru_cache(maxsize=1024) # orm生成的SQL种类有限，缓存后热路径上不需要每次都跑正则
+def sql_shape(sql):
+    '''
+    Normalize sql: collapse white spaces and replace literals by '?'.
+
+    >>> sql_shape("select * from `blogs`  where `id`='001' limit 10")
+    'select * from `blogs` where `id`=? limit ?'
+    '''
+    s = _RE_STRING.sub('?', sql)
+    s = _RE_NUMBER.sub('?', s)
+    return _RE_SPACES.sub(' ', s).strip()
+
+def args_fingerprint(args):
+    ' short hash of sql args, the args themselves are never stored. '
+    return hashlib.md5(repr(tuple(args or ())).encode('utf-8')).hexdigest()[:12]
+
+class SlowQueryLog(object):
+    '''
+    Ring buffer of slow queries. Each new slow shape is explained once.
+    '''
+    def __init__(self, threshold=0.2, size=100, explain=True):
+        self.threshold = threshold
+        self.explain = explain
+        self._entries = collections.deque(maxlen=size)
+        self._plans = dict() # shape => plan，同一个shape只EXPLAIN一次
+
+    def record(self, sql, args, duration, rows, driver=None):
+        if self.threshold is None or duration < self.threshold:
+            return None
+        shape = sql_shape(sql)
+        entry = dict(shape=shape, fingerprint=args_fingerprint(args), duration=duration, rows=rows, created_at=time.time(), plan=self._plans.get(shape))
+        self._entries.append(entry)
+        _logger.warning('slow query %.3fs rows=%s: %s', duration, rows, shape)
+        if self.explain and driver is not None and shape not in self._plans:
+            self._plans[shape] = None
+            asyncio.ensure_future(self._explain(driver, shape, sql, args, entry))
+        return entry
+
+    async def _explain(self, driver, shape, sql, args, entry):
+        try:
+            plan = await driver.explain(sql, args)
+        except Exception as e:
+            plan = 'explain failed: %s' % e
+        self._plans[shape] = plan
+        entry['plan'] = plan
+
+    def entries(self):
+        ' return slow queries, newest first. '
+        return [dict(e, plan=self._plans.get(e['shape'])) for e in reversed(self._entries)]
+
+    def clear(self):
+        self._entries.clear()
+        self._plans.clear()
+
+class QueryStats(object):
+    '''
+    Per digest statistics: count, total/mean/p95 time, rows and errors.
+    p95 is computed from the latest `samples` durations of each digest.
+    '''
+    def __init__(self, enabled=True, samples=200):
+        self.enabled = enabled
+        self.samples = samples
+        self.reset()
+
+    def reset(self):
+        self._stats = dict()
+        self.since = time.time()
+
+    def record(self, sql, duration, rows, error=False):
+        if not self.enabled:
+            return
+        shape = sql_shape(sql)
+        st = self._stats.get(shape)
+        if st is None:
+            st = self._stats[shape] = dict(count=0, total=0.0, max=0.0, rows=0, errors=0, durations=collections.deque(maxlen=self.samples))
+        st['count'] += 1
+        st['total'] += duration
+        st['rows'] += rows or 0
+        if duration > st['max']:
+            st['max'] = duration
+        if error:
+            st['errors'] += 1
+        st['durations'].append(duration)
+
+    def entries(self):
+        ' return statistics of all digests, sorted by total time desc. '
+        L = []
+        for shape, st in self._stats.items():
+            ds = sorted(st['durations'])
+            L.append(dict(
+                digest=hashlib.md5(shape.encode('utf-8')).hexdigest()[:16],
+                shape=shape,
+                count=st['count'],
+                total=st['total'],
+                mean=st['total'] / st['count'],
+                p95=ds[min(len(ds) - 1, int(len(ds) * 0.95))],
+                max=st['max'],
+                rows=st['rows'],
+                errors=st['errors']
+            ))
+        L.sort(key=lambda e: e['total'], reverse=True)
+        return L
+
+slow_queries = SlowQueryLog(**configs.slowquery)
+query_stats = QueryStats(**configs.querystats)
+
+def record(sql, args, duration, rows, driver=None, error=False):
+    ' called by orm after each statement. '
+    query_stats.record(sql, duration, rows, error)
+    if not error:
+        slow_queries.record(sql, args, duration, rows, driver)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
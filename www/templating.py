@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jassion Zhao'
+
+'''
+jinja2 environment.
+
+开发模式：auto_reload=True，每次get_template都会检查模板文件是否修改过，修改后立即生效。
+生产模式(configs.jinja2.production)：
+1. 关闭auto_reload，不再在每次请求时stat模板文件；
+2. 优先加载构建时预编译好的模板(python模块，见compile_all)，worker启动时不需要再编译；
+3. 没有预编译的模板使用bytecode cache，编译结果保存在磁盘上，重启后直接加载。
+
+构建时预编译所有模板(fab build会自动执行)：
+$ python3 templating.py templates_compiled
+'''
+
+import logging, os, sys, time
+from datetime import datetime
+
+from jinja2 import Environment, FileSystemLoader, ModuleLoader, ChoiceLoader, FileSystemBytecodeCache
+
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def datetime_filter(t):
+    delta = int(time.time() - t)
+    if delta < 60:
+        return u'1分钟前'
+    if delta < 60*60:
+        return u'%s分钟前' % (delta // 60)
+    if delta < 60*60*24:
+        return u'%s小时前' % (delta // (60*60))
+    if delta < 60*60*24*365:
+        return u'%s天前' % (delta // (60*60*24))
+    dt = datetime.fromtimestamp(t)
+    return u'%s年%s月%s日' % (dt.year, dt.month, dt.day)
+
+# 模板中用到的filter，预编译模板时也需要（编译时会检查filter是否存在）
+FILTERS = dict(datetime=datetime_filter)
+
+def _options(**kw):
+    return dict(
+        autoescape = kw.get('autoescape', True),
+        block_start_string = kw.get('block_start_string', '{%'),
+        block_end_string = kw.get('block_end_string', '%}'),
+        variable_start_string = kw.get('variable_start_string', '{{'),
+        variable_end_string = kw.get('variable_end_string', '}}'),
+        auto_reload = kw.get('auto_reload', True)
+    )
+
+def _abspath(path):
+    return path if os.path.isabs(path) else os.path.join(_BASE_DIR, path)
+
+def create_environment(path=None, production=False, bytecode_cache=None, compiled_path=None, filters=None, **kw):
+    '''
+    Create jinja2 Environment. In production mode auto reload is disabled,
+    precompiled templates (if any) and bytecode cache are used.
+    '''
+    if path is None:
+        path = os.path.join(_BASE_DIR, 'templates')
+    logging.info('set jinja2 template path: %s' % path)
+    loader = FileSystemLoader(path)
+    if production:
+        kw['auto_reload'] = False
+        if compiled_path and os.path.isdir(_abspath(compiled_path)):
+            logging.info('use precompiled templates: %s' % _abspath(compiled_path))
+            loader = ChoiceLoader([ModuleLoader(_abspath(compiled_path)), loader])
+        if bytecode_cache is not None:
+            # bytecode_cache为''时使用jinja2默认的临时目录
+            kw['bytecode_cache'] = FileSystemBytecodeCache(_abspath(bytecode_cache)) if bytecode_cache else FileSystemBytecodeCache()
+    options = _options(**kw)
+    if 'bytecode_cache' in kw:
+        options['bytecode_cache'] = kw['bytecode_cache']
+    env = Environment(loader=loader, **options)
+    env.filters.update(filters or FILTERS)
+    return env
+
+def preload(env, path=None):
+    '''
+    Load (and compile) all templates into the cache of env, return their names.
+    '''
+    names = FileSystemLoader(path or os.path.join(_BASE_DIR, 'templates')).list_templates()
+    for name in names:
+        env.get_template(name)
+    return names
+
+def compile_all(target, path=None, filters=None, **kw):
+    '''
+    Precompile all templates under path into python modules in target directory.
+    '''
+    env = Environment(loader=FileSystemLoader(path or os.path.join(_BASE_DIR, 'templates')), **_options(**kw))
+    env.filters.update(filters or FILTERS)
+    env.compile_templates(_abspath(target), zip=None, ignore_errors=False, log_function=logging.info)
+    return env.list_templates()
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    target = sys.argv[1] if len(sys.argv) > 1 else 'templates_compiled'
+    names = compile_all(target)
+    print('%s templates compiled to %s' % (len(names), _abspath(target)))
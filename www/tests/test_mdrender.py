@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jassion Zhao'
+
+'''
+tests of mdrender.
+
+在www目录下运行：
+$ python3 -m unittest discover -s tests
+'''
+
+import unittest
+from html.parser import HTMLParser
+
+try:
+    import pygments
+except ImportError:
+    pygments = None
+
+import mdrender
+
+class SafeMarkdownTest(unittest.TestCase):
+
+    def _attrs(self, html):
+        ' return names of all attributes as a browser parses them. '
+        names = []
+        class Parser(HTMLParser):
+            def handle_starttag(self, tag, attrs):
+                names.extend(name for name, value in attrs)
+        Parser().feed(html)
+        return names
+
+    def test_url_breaks_out_of_href(self):
+        html = mdrender.safe_markdown('[x](http://a" onmouseover="alert(1))')
+        self.assertNotIn('onmouseover', self._attrs(html))
+        self.assertIn('<a href="http://a', html)
+
+    def test_title_breaks_out_of_attribute(self):
+        html = mdrender.safe_markdown('[x](http://a.com "t\\" onmouseover=alert(1))')
+        self.assertNotIn('onmouseover', self._attrs(html))
+
+    def test_image_attributes(self):
+        html = mdrender.safe_markdown('![i" onerror="alert(1)](http://a/b.png "t")')
+        self.assertNotIn('onerror', self._attrs(html))
+        self.assertIn('src="http://a/b.png"', html)
+
+    def test_unsafe_scheme(self):
+        for url in ('javascript:alert(1)', 'JavaScript:alert(1)', 'java\tscript:alert(1)', 'data:text/html,x'):
+            html = mdrender.safe_markdown('[x](%s)' % url)
+            self.assertIn('href="#"', html, url)
+
+    def test_raw_html_escaped(self):
+        html = mdrender.safe_markdown('<script>alert(1)</script> <img src=x onerror=alert(1)>')
+        self.assertNotIn('<script', html)
+        self.assertNotIn('<img', html)
+
+    def test_markdown_kept(self):
+        html = mdrender.safe_markdown('**b** `a & b` [link](https://example.com "title")\n\n> q\n\n1. a\n2. b\n')
+        self.assertIn('<strong>b</strong>', html)
+        self.assertIn('<code>a &amp; b</code>', html)
+        self.assertIn('<a href="https://example.com" title="title">link</a>', html)
+        self.assertIn('<blockquote>', html)
+        self.assertIn('<li>a</li>', html)
+
+    def test_sanitize_html(self):
+        self.assertEqual(mdrender.sanitize_html('<p class="x" onclick="y">a &amp; b</p>'), '<p>a &amp; b</p>')
+        self.assertEqual(mdrender.sanitize_html('<div><script>alert(1)</script>t</div>'), 't')
+        self.assertEqual(mdrender.sanitize_html('<a href="http://a&quot; x=&quot;y">z</a>'), '<a href="http://a&quot; x=&quot;y">z</a>')
+
+class MarkdownTest(unittest.TestCase):
+
+    @unittest.skipUnless(pygments, 'pygments is not installed')
+    def test_code_block_wrapped_once(self):
+        html = mdrender.markdown('```python\ndef f():\n    return 1\n```\n', extras=['fenced-code-blocks'])
+        self.assertEqual(html.count('class="codehilite"'), 1, html)
+        self.assertIn('<div class="codehilite"><pre>', html)
+
+class IncrementalRendererTest(unittest.TestCase):
+
+    _EXTRAS = ['fenced-code-blocks', 'tables']
+
+    _DOCS = [
+        '# title\n\nparagraph with **bold**\n\n---\n\nlast',
+        '<div>\n\nhello\n\n</div>',
+        '<div class="note">\n<p>a</p>\n\n<p>b</p>\n</div>\n\nafter',
+        '> a\n\n> b',
+        '> a\n>\n> b\n\nnot quoted\n\n> c',
+        '- a\n\n- b\n\n    continued\n\n1. one\n2. two',
+        'text\n\n    indented code\n\n    more code\n\ntext',
+        '```python\ndef f():\n\n    return 1\n```\n\n| a | b |\n|---|---|\n| 1 | 2 |',
+        'see [link][1]\n\n[1]: http://example.com'
+    ]
+
+    def test_same_as_full_render(self):
+        renderer = mdrender.IncrementalRenderer(extras=self._EXTRAS)
+        for text in self._DOCS:
+            full = mdrender.markdown(text, extras=self._EXTRAS)
+            self.assertEqual(renderer.render(text), full, text)
+            self.assertEqual(renderer.render(text), full, text) # 第二次全部命中缓存
+
+    def test_edit_one_block(self):
+        renderer = mdrender.IncrementalRenderer(extras=self._EXTRAS)
+        text = '\n\n'.join(self._DOCS[:-1])
+        renderer.render(text)
+        misses = renderer.misses
+        edited = text.replace('last', 'changed')
+        self.assertEqual(renderer.render(edited), mdrender.markdown(edited, extras=self._EXTRAS))
+        self.assertEqual(renderer.misses, misses + 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jassion Zhao'
+
+'''
+per request timing.
+
+logger_middleware为每个请求创建一个Timing，保存在contextvar中（aiohttp的每个请求运行在单独的task里，互不影响），
+请求处理过程中的各个阶段用span()计时，同名的span累加耗时和次数：
+
+    with timing.span('db'):
+        rs = await __pool.select(sql, args, size)
+
+已有的span：auth(cookie2user)、handler(RequestHandler)、db(orm.select/execute)、md(markdown转换)、tpl(模板渲染)。
+
+请求结束时各阶段的耗时和请求id(rid)写入访问日志；管理员（或configs.timing.header为True时所有用户）的响应
+带上Server-Timing头，在浏览器开发者工具的Network -> Timing中可以直接看到。
+不在请求中（比如后台脚本、线程池中）调用span()时什么也不做。
+'''
+
+import contextvars, re, time, uuid
+
+_current = contextvars.ContextVar('timing', default=None)
+
+_RE_REQUEST_ID = re.compile(r'[\w\-]{1,64}') # 从请求头传入的id只接受这种格式，其他的重新生成
+
+class Timing(object):
+    '''
+    Accumulated durations of named spans of one request.
+    '''
+    def __init__(self, request_id=None):
+        self.request_id = request_id if request_id and _RE_REQUEST_ID.fullmatch(request_id) else uuid.uuid4().hex
+        self.start = time.perf_counter()
+        self.spans = dict() # name => [耗时(秒), 次数]
+
+    def add(self, name, seconds):
+        s = self.spans.get(name)
+        if s is None:
+            self.spans[name] = [seconds, 1]
+        else:
+            s[0] += seconds
+            s[1] += 1
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def header(self):
+        ' value of Server-Timing header. '
+        L = []
+        for name, (seconds, count) in self.spans.items():
+            if count > 1:
+                L.append('%s;dur=%.1f;desc="%d calls"' % (name, seconds * 1000, count))
+            else:
+                L.append('%s;dur=%.1f' % (name, seconds * 1000))
+        L.append('total;dur=%.1f' % (self.elapsed() * 1000))
+        return ', '.join(L)
+
+    def log_fields(self):
+        ' key=value fields for access log, e.g. "db=3.2/4 tpl=1.1" (ms/count). '
+        return ' '.join(('%s=%.1f/%d' % (name, seconds * 1000, count) if count > 1 else '%s=%.1f' % (name, seconds * 1000))
+                        for name, (seconds, count) in self.spans.items())
+
+def start(request_id=None):
+    ' create Timing for the current request. '
+    t = Timing(request_id)
+    _current.set(t)
+    return t
+
+def current():
+    return _current.get()
+
+class span(object):
+    '''
+    Context manager measuring the wrapped code as span `name` of the current request.
+    '''
+    __slots__ = ('name', 'timing', 'begin')
+
+    def __init__(self, name):
+        self.name = name
+        self.timing = _current.get()
+
+    def __enter__(self):
+        if self.timing is not None:
+            self.begin = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.timing is not None:
+            self.timing.add(self.name, time.perf_counter() - self.begin)
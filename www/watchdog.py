@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jassion Zhao'
+
+'''
+event loop lag monitor.
+
+markdown转换、模板渲染、大列表的json.dumps等同步代码都在事件循环的线程中运行，执行期间所有请求都在等待。
+watchdog由两部分组成：
+
+1. 事件循环中的心跳协程，每隔interval秒醒来一次，实际醒来的时间比预期晚了多少就是loop lag，
+   记入metrics（event_loop_lag_seconds直方图，以及最近一分钟的p50/p90/p99）；
+2. 一个后台线程，发现心跳超过threshold秒没有更新时（事件循环被阻塞），用sys._current_frames()
+   取得事件循环线程当前的调用栈，并从栈上找到正在处理的request（路由、rid）。
+
+阻塞结束后心跳协程输出一条WARNING日志，包括阻塞时长、请求和调用栈：
+
+    event loop blocked for 1312 ms: GET /blog/{id} path=/blog/0017... rid=3f2a...
+      File ".../handlers.py", line 120, in get_blog
+        blog.html_content = markdown2.markdown(blog.content)
+      ...
+
+注意：后台线程需要拿到GIL才能运行，如果阻塞发生在一直不释放GIL的C代码中（比如一个很慢的正则表达式），
+只能在它返回后才采样，这时日志中只有阻塞时长，没有调用栈。
+'''
+
+import asyncio, collections, logging, sys, threading, time, traceback
+
+from aiohttp import web
+
+import metrics
+
+_logger = logging.getLogger('watchdog')
+
+_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+_STACK_LIMIT = 25 # 日志中最多保留最内层的多少帧
+
+lag_seconds = metrics.registry.histogram('event_loop_lag_seconds', 'Event loop lag measured by the watchdog heartbeat.', buckets=_LAG_BUCKETS)
+blocked_total = metrics.registry.counter('event_loop_blocked_total', 'Times the event loop was blocked longer than the watchdog threshold.')
+
+def walk(frame):
+    '''
+    [(frame, lineno)] from innermost to outermost. The loop thread keeps running while other threads
+    look at its frames (a suspended generator loses f_back), so the chain is copied in one quick pass.
+    '''
+    frames = []
+    while frame is not None:
+        frames.append((frame, frame.f_lineno))
+        frame = frame.f_back
+    return frames
+
+def find_request(frames):
+    ' innermost aiohttp request found in locals of frames returned by walk(). '
+    for frame, lineno in frames:
+        if 'request' in frame.f_code.co_varnames: # 先检查变量名，避免为每一帧生成f_locals（profiler每秒采样上百次）
+            request = frame.f_locals.get('request')
+            if isinstance(request, web.BaseRequest):
+                return request
+    return None
+
+def describe(request):
+    ' route, path and request id of request for the log. '
+    if request is None:
+        return 'no request'
+    t = getattr(request, '__timing__', None)
+    return '%s %s path=%s rid=%s' % (request.method, metrics.route_of(request), request.path, t.request_id if t else '-')
+
+class Watchdog(object):
+    '''
+    Measure loop lag every interval seconds, capture the stack of the loop thread when it is blocked longer than threshold.
+    '''
+    def __init__(self, interval=0.1, threshold=0.2, window=600):
+        self.interval = interval
+        self.threshold = threshold
+        self.recent = collections.deque(maxlen=window) # 最近window次的lag，用于计算百分位数
+        self._beat = time.monotonic() # 心跳协程最近一次醒来的时间
+        self._captured = None # 后台线程在本次阻塞中捕获的(请求描述, 调用栈)
+        self._thread_id = None
+        self._task = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        ' start in the loop thread. '
+        self._thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._task = asyncio.ensure_future(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name='watchdog', daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._thread is not None:
+            self._thread.join()
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._beat = now
+            lag = max(0.0, now - expected)
+            lag_seconds.observe(lag)
+            self.recent.append(lag)
+            if lag >= self.threshold:
+                self._report(lag)
+            else:
+                self._captured = None
+
+    def _report(self, lag):
+        blocked_total.inc()
+        captured, self._captured = self._captured, None
+        if captured is None:
+            _logger.warning('event loop blocked for %.0f ms (no stack captured).', lag * 1000)
+        else:
+            _logger.warning('event loop blocked for %.0f ms: %s\n%s', lag * 1000, captured[0], captured[1])
+
+    def _watch(self):
+        reported = None # 已经捕获过的心跳，每次阻塞只采样一次
+        while not self._stopped.wait(self.interval / 2):
+            beat = self._beat
+            if beat == reported or time.monotonic() - beat - self.interval < self.threshold: # 与心跳协程计算lag的方式一致
+                continue
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            frames = walk(frame)
+            del frame
+            try:
+                stack = ''.join(traceback.StackSummary.extract(reversed(frames[:_STACK_LIMIT])).format())
+                self._captured = (describe(find_request(frames)), stack)
+            finally:
+                del frames # 不要让线程一直引用事件循环线程的帧
+            reported = beat
+
+    def quantiles(self):
+        ' p50/p90/p99 of recent lags, dict of labels tuple => seconds for metrics. '
+        lags = sorted(self.recent)
+        if not lags:
+            return dict()
+        return {(q,): lags[min(len(lags) - 1, int(len(lags) * float(q)))] for q in ('0.5', '0.9', '0.99')}
+
+_watchdog = None
+
+metrics.registry.callback('gauge', 'event_loop_lag_recent_seconds', 'Quantiles of event loop lag in the last minute (max of workers).',
+    lambda: _watchdog.quantiles() if _watchdog is not None else None, ('quantile',), mode='max')
+
+def setup(app, interval=0.1, threshold=0.2):
+    ' start the watchdog with app, one per worker process. '
+    async def on_startup(app):
+        global _watchdog
+        _watchdog = Watchdog(interval, threshold, window=max(1, int(60 / interval)))
+        _watchdog.start()
+    async def on_cleanup(app):
+        if _watchdog is not None:
+            await _watchdog.stop()
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)